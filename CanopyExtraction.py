@@ -1,20 +1,27 @@
 import trimesh
-from trimesh.transformations import translation_matrix
 import laspy
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib import cm
+from matplotlib.figure import Figure
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix
 from laspy import ExtraBytesParams
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import os
+from VoxelEngine import voxel_grid_indices, linear_voxel_keys
+from LasDataset import as_dataset
+from SharedPoints import attach_points, shared_point_pool
 
 
 def crop_high_points(las_file):
-    # Read the LAS file
-    las = laspy.read(las_file)
+    # Read the LAS file, unless a decoded LasDataset is given
+    dataset = as_dataset(las_file)
 
     # Filter points with height (z) < 1.5
-    mask = las.z < 1.5
-    low_points = las.points[mask]
+    mask = dataset.below(1.5)
+    low_points = dataset.las.points[mask]
 
     return low_points
 
@@ -58,169 +65,329 @@ def delete_points(las_point_cloud, center_x, center_y, inner_radius, minimum_hei
 
     return mask
 
-def func_DBSCAN(las, las_points, eps, min_samples, image_path):
-
-    # # getting scaling and offset parameters
-    # las_scaleX = las.header.scale[0]
-    # las_offsetX = las.header.offset[0]
-    # las_scaleY = las.header.scale[1]
-    # las_offsetY = las.header.offset[1]
-    # las_scaleZ = las.header.scale[2]
-    # las_offsetZ = las.header.offset[2]
-
-    # # calculating coordinates
-    # p_X = np.array((las_points.x * las_scaleX) + las_offsetX)
-    # p_Y = np.array((las_points.y * las_scaleY) + las_offsetY)
-    # p_Z = np.array((las_points.z * las_scaleZ) + las_offsetZ)
-
-    # # plotting points
-    # fig = plt.figure()
-    # ax = fig.add_subplot(111, projection='3d')
-    # ax.scatter(p_X, p_Y, p_Z, c='r', marker='o')
-    # plt.show()
-
-    low_las = laspy.create(point_format=las.header.point_format, file_version=las.header.version)
-    low_las.header = las.header
-    low_las.points = las_points
+def stored_height(value, scale, offset):
+    """Height as a stored LAS integer; laspy compares las.z against a value on these integers."""
+    return np.round((value - offset) / scale)
+
+def cylinder_indices(xy_index, center_x, center_y, radius):
+    """Indices of the points within radius of the center in XY."""
+    # Slightly larger query, the exact radius test is done by the callers on the radii
+    return np.asarray(xy_index.query_ball_point([center_x, center_y], radius * (1 + 1e-9)), dtype=np.int64)
+
+def cylinder_neighbourhood(indices, x, y, stored_z, center_x, center_y):
+    """Indices, XY radii and stored heights of the given points around the center, sorted by height."""
+    indices = indices[np.argsort(stored_z[indices], kind="stable")]
+    radii = np.sqrt((x[indices] - center_x) ** 2 + (y[indices] - center_y) ** 2)
+    return indices, radii, stored_z[indices]
+
+def first_ring_offset(ring_stored_z, origin_z, height, spacing, scale, offset, steps=100):
+    """Height of the first ring, stacked every spacing from origin_z, that holds one of the given points.
+
+    Gives the same z_offset as moving the ring up one spacing at a time until points_inside_ring
+    finds a point (the last of the steps rings if none does), without testing every step.
+    """
+    # Lowest step whose ring reaches each point, with its neighbours (and step 0) checked exactly
+    ring_z = ring_stored_z * scale + offset
+    lowest = np.floor((ring_z - origin_z - height / 2) / spacing).astype(np.int64)
+    candidates = np.concatenate((lowest - 1, lowest, lowest + 1, np.zeros(len(ring_z), dtype=np.int64)))
+    candidate_z = np.tile(ring_stored_z, 4)
+    center_z = origin_z + candidates * spacing
+    inside = ((candidates >= 0) & (candidates < steps)
+              & (candidate_z >= stored_height(center_z - height / 2, scale, offset))
+              & (candidate_z <= stored_height(center_z + height / 2, scale, offset)))
+    step = candidates[inside].min() if inside.any() else steps - 1
+    return origin_z + step * spacing
+
+def detect_stem(indices, x, y, stored_z, origin_x, origin_y, origin_z, inner_radius, outer_radius, height, spacing, z_scale, z_origin):
+    """Ring height above a cluster origin and the stem points found at it.
+
+    indices are the points around the origin, as given by cylinder_indices with the larger radius.
+    Returns (z_offset, number of stem points, minimum height of the stem points or None without any).
+    """
+    # Points around the stem, sorted by height
+    indices, radii, heights = cylinder_neighbourhood(indices, x, y, stored_z, origin_x, origin_y)
+
+    # Find the z_offset of the first ring (of up to 100, spanning the full tree height) that holds points
+    in_ring = (radii >= inner_radius) & (radii <= outer_radius)
+    z_offset = first_ring_offset(heights[in_ring], origin_z, height, spacing, z_scale, z_origin)
+
+    # Stem points up to detected height: the inner ring points in the height window of the ring
+    start = np.searchsorted(heights, stored_height(z_offset - height / 2, z_scale, z_origin), side="left")
+    stop = np.searchsorted(heights, stored_height(z_offset + height / 2, z_scale, z_origin), side="right")
+    stem_heights = heights[start:stop][radii[start:stop] <= inner_radius]
+    if len(stem_heights) == 0:
+        return z_offset, 0, None
+    return z_offset, len(stem_heights), stem_heights[0] * z_scale + z_origin
+
+def _detect_stems_task(task):
+    # Runs in a pool worker: detects the stems of a run of clusters on the shared coordinates
+    descriptor, indices, bounds, origins, parameters = task
+    points = attach_points(descriptor)
+    x, y, stored_z = points[:, 0], points[:, 1], points[:, 2]
+    return [detect_stem(indices[start:stop], x, y, stored_z, *origin, *parameters)
+            for start, stop, origin in zip(bounds[:-1], bounds[1:], origins)]
+
+def detect_stems_parallel(dataset, origins, parameters, processes=None):
+    """detect_stem for every (origin_x, origin_y, origin_z) on a process pool, results in origin order.
+
+    The neighbourhoods are queried here on dataset.xy_index and the coordinates are published
+    once in shared memory; each worker gets a contiguous run of clusters with the indices of
+    their points, so that the results come back in the order of the origins.
+    """
+    inner_radius, outer_radius = parameters[:2]
+    radius = max(inner_radius, outer_radius)
+    neighbourhoods = [cylinder_indices(dataset.xy_index, origin_x, origin_y, radius) for origin_x, origin_y, _ in origins]
+    coordinates = np.column_stack((dataset.x, dataset.y, dataset.stored_z))
+    with shared_point_pool(coordinates, processes) as (store, pool):
+        runs = np.array_split(np.arange(len(origins)), 4 * (processes or os.cpu_count()))
+        tasks = []
+        for run in runs:
+            if len(run):
+                run_indices = [neighbourhoods[i] for i in run]
+                bounds = np.concatenate(([0], np.cumsum([len(indices) for indices in run_indices])))
+                tasks.append((store.descriptor, np.concatenate(run_indices), bounds, origins[run], parameters))
+        return [stem for part in pool.map(_detect_stems_task, tasks) for stem in part]
+
+def stem_keep_mask(dataset, stems):
+    """Mask of the points of the dataset outside every stem cylinder.
+
+    A stem is (center_x, center_y, radius, minimum_height): the points within radius of the
+    center in XY and not above minimum_height. All stems are looked up in one XY KD-tree query.
+    """
+    keep = np.ones(len(dataset), dtype=bool)
+    if len(stems) == 0:
+        return keep
+    stems = np.asarray(stems, dtype=np.float64)
+
+    # Slightly larger query, the exact radius test is done on the distances below
+    neighbours = dataset.xy_index.query_ball_point(stems[:, :2], stems[:, 2] * (1 + 1e-9))
+    stem = np.repeat(np.arange(len(stems)), [len(n) for n in neighbours])
+    indices = np.concatenate(neighbours).astype(np.int64)
+    radii = np.sqrt((dataset.x[indices] - stems[stem, 0]) ** 2 + (dataset.y[indices] - stems[stem, 1]) ** 2)
+
+    # Heights compared on the stored integers, as las.z <= minimum_height does
+    top = stored_height(stems[:, 3], dataset.header.scales[2], dataset.header.offsets[2])
+    inside = (radii <= stems[stem, 2]) & (dataset.stored_z[indices] <= top[stem])
+    keep[indices[inside]] = False
+    return keep
+
+def thin_points(points, voxel_size):
+    """Centroid and point count of every occupied voxel, and the voxel of every point."""
+    keys, _, _ = linear_voxel_keys(voxel_grid_indices(points, voxel_size, points.min(axis=0)))
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    centroids = np.column_stack([np.bincount(inverse, weights=points[:, axis]) for axis in range(3)]) / counts[:, None]
+    return centroids, counts, inverse
+
+def save_cluster_image(points, labels, core_samples_mask, image_path):
+    """Saves the XY view of the clusters, drawn with one scatter call and without opening a window."""
+    unique_labels = np.unique(labels)
+    n_clusters_ = len(unique_labels) - (1 if -1 in unique_labels else 0)
+
+    # One Spectral colour per label, black used for noise
+    colors = cm.Spectral(np.linspace(0, 1, len(unique_labels)))
+    colors[unique_labels == -1] = [0, 0, 0, 1]
+    point_colors = colors[np.searchsorted(unique_labels, labels)]
+    sizes = np.where(core_samples_mask, 14 ** 2, 6 ** 2)
+
+    fig = Figure()
+    ax = fig.add_subplot(111)
+    ax.scatter(points[:, 0], points[:, 1], s=sizes, c=point_colors, edgecolors="k", rasterized=True)
+    ax.set_title(f"Estimated number of clusters: {n_clusters_}")
+    fig.savefig(image_path)
+
+def dbscan_samples(points, thinning_size=None):
+    """Samples clustered by DBSCAN, their weights and the sample of every point (None without thinning)."""
+    if thinning_size:
+        return thin_points(points, thinning_size)
+    return points, None, None
+
+def func_DBSCAN(las, las_points, eps, min_samples, image_path, thinning_size=None, n_jobs=-1):
+    """DBSCAN labels of the low points, with the cluster image saved to image_path (skipped when None).
+
+    The neighbours are searched in a KD-tree on n_jobs processes. With thinning_size the
+    points are first merged into voxel centroids of that size, weighted by their point
+    count, and every point takes the label of its voxel.
+    """
     points_low_las = np.vstack((las_points.x, las_points.y, las_points.z)).T
 
     # implementing DBSCAN
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(points_low_las)
+    samples, weights, inverse = dbscan_samples(points_low_las, thinning_size)
+    db = DBSCAN(eps=eps, min_samples=min_samples, algorithm="kd_tree", n_jobs=n_jobs).fit(samples, sample_weight=weights)
     labels = db.labels_
-
-    # Number of clusters in labels, ignoring noise if present.
-    n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-    # n_noise_ = list(labels).count(-1)
-
-    unique_labels = set(labels)
     core_samples_mask = np.zeros_like(labels, dtype=bool)
     core_samples_mask[db.core_sample_indices_] = True
+    if inverse is not None:
+        labels = labels[inverse]
+        core_samples_mask = core_samples_mask[inverse]
 
-    colors = [plt.cm.Spectral(each) for each in np.linspace(0, 1, len(unique_labels))]
-    for k, col in zip(unique_labels, colors):
-        if k == -1:
-            # Black used for noise.
-            col = [0, 0, 0, 1]
-
-        class_member_mask = labels == k
-
-        xy = points_low_las[class_member_mask & core_samples_mask]
-        plt.plot(
-            xy[:, 0],
-            xy[:, 1],
-            "o",
-            markerfacecolor=tuple(col),
-            markeredgecolor="k",
-            markersize=14,
-        )
-
-        xy = points_low_las[class_member_mask & ~core_samples_mask]
-        plt.plot(
-            xy[:, 0],
-            xy[:, 1],
-            "o",
-            markerfacecolor=tuple(col),
-            markeredgecolor="k",
-            markersize=6,
-        )
-
-    plt.title(f"Estimated number of clusters: {n_clusters_}")
-    plt.savefig(image_path)
-    plt.show()
+    if image_path is not None:
+        save_cluster_image(points_low_las, labels, core_samples_mask, image_path)
 
+    unique_labels = set(labels)
     return labels, unique_labels
 
-def extracting_tree_crown_points(laz_path, out_low_las, las_folder_path, ring_folder_path, image_path, dbscan_eps, dbscan_min_samples, inner_radius, outer_radius, height, spacing):
-
-    las = laspy.read(laz_path)
-    points = np.vstack((las.x, las.y, las.z)).T
-
-    # Create a new LAS file from low_points
+def neighbour_graph(samples, radius, graph_path, source_stamp, thinning_size=None, n_jobs=-1):
+    """Sparse graph of the distances between the samples closer than radius, cached in graph_path.
+
+    The cached graph is reused while the source_stamp of the points (see LasDataset.stamp) is
+    unchanged, the thinning size is the same and its radius is at least the requested one;
+    otherwise it is rebuilt and saved.
+    """
+    stamp = np.append(source_stamp, len(samples)).astype(np.int64)
+    thinning_size = thinning_size or 0.0
+
+    if os.path.exists(graph_path):
+        cached = np.load(graph_path)
+        if np.array_equal(cached["stamp"], stamp) and cached["thinning_size"] == thinning_size and cached["radius"] >= radius:
+            print(f"Loaded neighbour graph (radius {float(cached['radius'])}) from {graph_path}")
+            return csr_matrix((cached["data"], cached["indices"], cached["indptr"]), shape=(len(samples), len(samples)))
+
+    # Rows sorted by distance, so DBSCAN can use the graph for any smaller eps
+    neighbours = NearestNeighbors(radius=radius, algorithm="kd_tree", n_jobs=n_jobs).fit(samples)
+    graph = neighbours.radius_neighbors_graph(samples, mode="distance", sort_results=True)
+    np.savez(graph_path, data=graph.data, indices=graph.indices, indptr=graph.indptr, stamp=stamp, thinning_size=thinning_size, radius=radius)
+    print(f"Saved neighbour graph (radius {radius}) to {graph_path}")
+    return graph
+
+def dbscan_sweep(las_file, eps_values, min_samples_values, graph_path, thinning_size=None, n_jobs=-1):
+    """Number of clusters and noise points of the low points for every eps / min_samples pair.
+
+    The neighbours are searched once, at the largest eps, and every pair is clustered
+    from that cached graph. Returns a list of (eps, min_samples, clusters, noise points).
+    """
+    dataset = as_dataset(las_file)
+    points_low_las = dataset.xyz[dataset.below(1.5)]
+    samples, weights, _ = dbscan_samples(points_low_las, thinning_size)
+    point_weights = np.ones(len(samples), dtype=np.int64) if weights is None else weights
+    graph = neighbour_graph(samples, max(eps_values), graph_path, dataset.stamp, thinning_size, n_jobs)
+
+    results = []
+    for eps in eps_values:
+        for min_samples in min_samples_values:
+            labels = DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed").fit(graph, sample_weight=weights).labels_
+            n_clusters_ = len(np.unique(labels[labels >= 0]))
+            n_noise_ = int(point_weights[labels == -1].sum())
+            print(f"eps: {eps} min_samples: {min_samples} clusters: {n_clusters_} noise points: {n_noise_}")
+            results.append((eps, min_samples, n_clusters_, n_noise_))
+
+    return results
+
+def cluster_origins(low_points, labels):
+    """Labels, mean x, mean y and lowest z of every cluster of the low points, noise (-1) left out.
+
+    The points are grouped with one stable sort of the labels; the sort order and the start of
+    every cluster in it are returned too.
+    """
+    order = np.argsort(labels, kind="stable")
+    cluster_labels, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    clusters = cluster_labels >= 0
+    cluster_labels, starts, counts = cluster_labels[clusters], starts[clusters], counts[clusters]
+    if len(cluster_labels) == 0:
+        return cluster_labels, np.zeros(0), np.zeros(0), np.zeros(0), order, starts
+
+    # The noise sorts first, so every cluster runs from its start to the next one
+    origins_x = np.add.reduceat(np.asarray(low_points.x)[order], starts) / counts
+    origins_y = np.add.reduceat(np.asarray(low_points.y)[order], starts) / counts
+    lowest_z = np.minimum.reduceat(np.asarray(low_points.Z)[order], starts)
+    origins_z = lowest_z * low_points.scales[2] + low_points.offsets[2]
+    return cluster_labels, origins_x, origins_y, origins_z, order, starts
+
+def write_cluster_las_files(las, low_points, labels, cluster_labels, order, starts, las_folder_path):
+    """Writes the low points of every cluster to label_<i>.las, with their label as extra dimension."""
     low_las = laspy.create(point_format=las.header.point_format, file_version=las.header.version)
-    low_points = crop_high_points(laz_path)
-    low_las.header = las.header
-    low_las.points = low_points
-    low_las.write(out_low_las)
-
-    labels, unique_labels = func_DBSCAN(las, low_points, dbscan_eps, dbscan_min_samples, image_path)
-
-    # Copy existing point data
-    for dim in las.point_format.dimension_names:
-        setattr(low_las, dim, getattr(las, dim)[las.z < 1.5])  # same mask as used in crop_high_points()
+    low_las.header = copy.deepcopy(las.header)
+    low_las.points = low_points.copy()
 
     # Add labels as extra dimension
     label_dim = ExtraBytesParams(name="label", type=np.uint16)
     low_las.add_extra_dim(label_dim)
     low_las["label"] = labels
 
-    for i in unique_labels:
-        mask = low_las.label == i
-        label_points = low_las.points[mask]
-
-        filtered_labelled_las = laspy.create(point_format=las.header.point_format, file_version=las.header.version)
-        filtered_labelled_las.header = las.header
-        filtered_labelled_las.points = label_points
-        os.makedirs(las_folder_path, exist_ok=True)
+    os.makedirs(las_folder_path, exist_ok=True)
+    stops = np.append(starts[1:], len(order))
+    for i, start, stop in zip(cluster_labels, starts, stops):
+        filtered_labelled_las = laspy.create(point_format=low_las.header.point_format, file_version=low_las.header.version)
+        filtered_labelled_las.header = low_las.header
+        filtered_labelled_las.points = low_las.points[order[start:stop]]
         output_path = os.path.join(las_folder_path, f"label_{i}.las")
         filtered_labelled_las.write(output_path)
 
-    # List all LAS/LAZ files
-    las_files = [f for f in os.listdir(las_folder_path) if f.lower().endswith((".las", ".laz"))]
+def write_ring_meshes(ring_mesh, translations, ring_mesh_path):
+    """Writes one copy of the ring mesh per (x, y, z) translation, all in a single mesh file."""
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+    vertices = (ring_mesh.vertices[None, :, :] + translations[:, None, :]).reshape(-1, 3)
+    faces = (ring_mesh.faces[None, :, :] + len(ring_mesh.vertices) * np.arange(len(translations))[:, None, None]).reshape(-1, 3)
+    trimesh.Trimesh(vertices=vertices, faces=faces, process=False).export(ring_mesh_path)
 
-    # Create the ring mesh
-    ring_mesh = trimesh.creation.annulus(r_min=inner_radius, r_max=outer_radius, height=height)
-    combined_deletion = []
+def extracting_tree_crown_points(laz_path, out_low_las, las_folder_path, ring_folder_path, image_path, dbscan_eps, dbscan_min_samples, inner_radius, outer_radius, height, spacing, dbscan_thinning_size=None, dbscan_n_jobs=-1, export_cluster_las=False, stem_processes=1, export_rings=False):
 
-    print(f"Initial point count: {len(las.x)}")
+    # Decode the input once (laz_path may already be a LasDataset)
+    dataset = as_dataset(laz_path)
+    las = dataset.las
 
-    # Iterate over label files
-    for j, filename in enumerate(las_files):
-        file_path = os.path.join(las_folder_path, filename)
-        las_label = laspy.read(file_path)
-        if len(las_label.x) == 0:
-            print(f"Skipping empty file: {filename}")
-            continue
+    # Create a new LAS file from low_points
+    low_points = crop_high_points(dataset)
+    dataset.subset(dataset.below(1.5)).write(out_low_las)
 
-        origin_x = np.mean(las_label.x)
-        origin_y = np.mean(las_label.y)
-        origin_z = np.min(las_label.z)
+    labels, unique_labels = func_DBSCAN(las, low_points, dbscan_eps, dbscan_min_samples, image_path, dbscan_thinning_size, dbscan_n_jobs)
 
-        print("Cluster: ", j)
-        print("origin_x:", origin_x, "origin_y:", origin_y, "origin_z:", origin_z)
+    # Origin of every cluster, computed from the labelled low points in memory
+    cluster_labels, origins_x, origins_y, origins_z, order, starts = cluster_origins(low_points, labels)
+
+    # The per-cluster LAS files are only an export, written in the background while the stems are searched
+    writer = None
+    if export_cluster_las:
+        writer = ThreadPoolExecutor(max_workers=1)
+        export = writer.submit(write_cluster_las_files, las, low_points, labels, cluster_labels, order, starts, las_folder_path)
+
+    # The final ring of every cluster is only kept as its translation
+    ring_translations = []
+    combined_deletion = []
+
+    print(f"Initial point count: {len(dataset)}")
 
-        # Create mesh and find z_offset where it intersects points
-        for i in range(100): # Use a sufficiently large upper limit (100) to ensure the z_offset spans the full tree height
-            z_offset = origin_z + i * spacing
-            T = translation_matrix([origin_x, origin_y, z_offset])
-            mesh_copy = ring_mesh.copy()
-            mesh_copy.apply_transform(T)
+    # Every cluster only looks at its own cylinder of the XY index over the whole cloud
+    z_scale, z_origin = dataset.header.scales[2], dataset.header.offsets[2]
+    origins = np.column_stack((origins_x, origins_y, origins_z))
+    parameters = (inner_radius, outer_radius, height, spacing, z_scale, z_origin)
 
-            ring_folder = ring_folder_path + "/" + str(j)
-            os.makedirs(ring_folder, exist_ok=True)
-            mesh_copy.export(os.path.join(ring_folder, "higher_ring.stl"))
+    # Every cluster is independent: more than one stem process searches them on a pool
+    if stem_processes == 1:
+        radius = max(inner_radius, outer_radius)
+        stems = [detect_stem(cylinder_indices(dataset.xy_index, origin[0], origin[1], radius), dataset.x, dataset.y, dataset.stored_z, *origin, *parameters)
+                 for origin in origins]
+    else:
+        stems = detect_stems_parallel(dataset, origins, parameters, stem_processes)
 
-            ring_points = points_inside_ring(las, origin_x, origin_y, z_offset, inner_radius, outer_radius, height)
+    # Report and export the clusters in label order
+    for j, (origin_x, origin_y, origin_z), (z_offset, stem_count, minimum_height) in zip(cluster_labels, origins, stems):
+        print("Cluster: ", j)
+        print("origin_x:", origin_x, "origin_y:", origin_y, "origin_z:", origin_z)
 
-            if len(ring_points.points) != 0:
-                break
+        ring_translations.append([origin_x, origin_y, z_offset])
 
         print("origin_x: ", origin_x)
         print("origin_y: ", origin_y)
         print("z_offset: ", z_offset)
 
-        # Remove stem points up to detected height
-        points_above = func_points_inside_inner_higher_ring(las, origin_x, origin_y, z_offset, inner_radius, height)
-
-        if len(points_above.z) == 0:
+        if stem_count == 0:
             print(f"No points in ring at iteration {j}, skipping deletion.")
             continue
-        print("Number of stem points: ", len(points_above.z))
-        minimum_height = min(points_above.z)
+        print("Number of stem points: ", stem_count)
         # print("Minimum Height: ", minimum_height)
 
-        # Compute deletion mask from current filtered_las
-        deletion_mask = delete_points(las, origin_x, origin_y, inner_radius, minimum_height)
-        combined_deletion.append(deletion_mask)
+        # Keep the stem as its cylinder, the points are only removed once all stems are known
+        combined_deletion.append((origin_x, origin_y, inner_radius, minimum_height))
+
+    # Debug output: all the rings at their final height, written once as one mesh
+    if export_rings:
+        ring_mesh = trimesh.creation.annulus(r_min=inner_radius, r_max=outer_radius, height=height)
+        os.makedirs(ring_folder_path, exist_ok=True)
+        write_ring_meshes(ring_mesh, ring_translations, os.path.join(ring_folder_path, "rings.stl"))
+
+    if writer is not None:
+        export.result()
+        writer.shutdown()
 
     return combined_deletion
 
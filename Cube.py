@@ -1,72 +1,62 @@
-import open3d as o3d
+import laspy
+import numpy as np
 import os
-
-def cubes(xyz_ply, size, output_obj_file_path):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    assets_path = os.path.join(script_dir, "assets")
-
-    file_name = os.path.basename(xyz_ply)
-    file = os.path.splitext(file_name)
-
-    # Read the PLY file
-    point_cloud = o3d.io.read_point_cloud(xyz_ply)
-    points = point_cloud.points
-
-
-    # Function to create a cube with the point as the centroid
-    def create_cube_3d(x, y, z, size):
-        half_size = size / 2
-        # Define cube vertices (3D)
-        vertices = [
-            (x - half_size, y - half_size, z - half_size),  # Bottom-left-front
-            (x + half_size, y - half_size, z - half_size),  # Bottom-right-front
-            (x + half_size, y + half_size, z - half_size),  # Top-right-front
-            (x - half_size, y + half_size, z - half_size),  # Top-left-front
-            (x - half_size, y - half_size, z + half_size),  # Bottom-left-back
-            (x + half_size, y - half_size, z + half_size),  # Bottom-right-back
-            (x + half_size, y + half_size, z + half_size),  # Top-right-back
-            (x - half_size, y + half_size, z + half_size),  # Top-left-back
-        ]
-        # Define cube faces (indices into the vertex list)
-        faces = [
-            (1, 2, 3, 4),  # Front face
-            (5, 6, 7, 8),  # Back face
-            (1, 5, 8, 4),  # Left face
-            (2, 6, 7, 3),  # Right face
-            (4, 3, 7, 8),  # Top face
-            (1, 2, 6, 5),  # Bottom face
-        ]
-        return vertices, faces
-
-    # Extract X, Y, and Z coordinates from the PLY file
-    cubes = []
-    for point in points:
-        x, y, z = point
-        cubes.append(create_cube_3d(x, y, z, size))  # 2 cm cube
-
-    # Write to OBJ file
-    with open(output_obj_file_path, 'w') as obj_file:
-        vertex_index = 1  # Track vertex indices for faces
-        for cube in cubes:
-            vertices, faces = cube
-            # Write vertices
-            for vertex in vertices:
-                obj_file.write(f"v {vertex[0]} {vertex[1]} {vertex[2]}\n")
-            # Write faces (connecting vertices in order)
-            for face in faces:
-                obj_file.write(f"f {face[0] + vertex_index - 1} {face[1] + vertex_index - 1} "
-                               f"{face[2] + vertex_index - 1} {face[3] + vertex_index - 1}\n")
-            vertex_index += 8  # Move to the next set of vertices
-
-    print(f"OBJ file created at: {output_obj_file_path}")
+from VoxelEngine import count_points_pyramid, voxel_centers
+from VoxelMeshWriter import write_cubes, write_instanced_cubes
+
+
+def cube_centers(point_cloud):
+    """Returns the (N x 3) points of a point array, a LAS object or a PLY/LAS file path."""
+    if isinstance(point_cloud, (str, os.PathLike)):
+        if os.path.splitext(point_cloud)[1].lower() in (".las", ".laz"):
+            point_cloud = laspy.read(point_cloud)
+        else:
+            # Open3D is only imported when a PLY file has to be read
+            import open3d as o3d
+            return np.asarray(o3d.io.read_point_cloud(os.fspath(point_cloud)).points)
+    if isinstance(point_cloud, laspy.LasData):
+        return np.vstack((point_cloud.x, point_cloud.y, point_cloud.z)).T
+    return np.asarray(point_cloud, dtype=np.float64)[:, :3]
+
+def lod_output_path(output_obj_file_path, size):
+    """Output path of the level of detail with the given cube size."""
+    root, extension = os.path.splitext(output_obj_file_path)
+    return root + "_lod_" + str(size) + extension
+
+def write_cube_file(centers, size, output_obj_file_path, instanced=False):
+    if instanced:
+        if os.path.splitext(output_obj_file_path)[1].lower() != ".glb":
+            raise ValueError("Instanced cubes are written as .glb files")
+        write_instanced_cubes(centers, size, output_obj_file_path)
+    else:
+        # Write a cube with every point as the centroid, building the cubes as arrays chunk by chunk
+        write_cubes(centers, size, output_obj_file_path)
+
+    print(f"Mesh file created at: {output_obj_file_path}")
+
+def cubes(point_cloud, size, output_obj_file_path, instanced=False, dedup=False, lod_sizes=()):
+    """Writes a cube of the given size around every point.
+
+    point_cloud is an (N x 3+) point array, a LAS object or the path of a PLY or LAS file.
+    With instanced=True the output must be a .glb file holding one cube mesh and
+    one translation per point (EXT_mesh_gpu_instancing), instead of a cube per point.
+    With dedup=True the cubes are snapped to a grid of cube-sized cells, one cube per
+    occupied cell. Every size of lod_sizes adds a coarser snapped level of detail,
+    written next to the output as <name>_lod_<size>.
+    """
+    points = cube_centers(point_cloud)
+    outputs = [(points, size, output_obj_file_path)]
+
+    if dedup or lod_sizes:
+        # One grouping of the points gives the occupied cells of every cube size
+        origin = points.min(axis=0)
+        levels = count_points_pyramid(points, [size] + list(lod_sizes), origin)
+        if dedup:
+            outputs = [(voxel_centers(levels[size][0], size, origin), size, output_obj_file_path)]
+        for lod_size in lod_sizes:
+            outputs.append((voxel_centers(levels[lod_size][0], lod_size, origin), lod_size, lod_output_path(output_obj_file_path, lod_size)))
+
+    for centers, cube_size, cube_path in outputs:
+        write_cube_file(centers, cube_size, cube_path, instanced)
 
     return None
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,85 @@
+import copy
+import os
+import laspy
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class LasDataset:
+    """A LAS/LAZ point cloud decoded once, keeping its coordinate arrays and masks for every stage."""
+
+    def __init__(self, las):
+        # las is a file path, or a LasData already in memory (then path is None)
+        if isinstance(las, laspy.LasData):
+            self.path = None
+            self.las = las
+        else:
+            self.path = las
+            self.las = laspy.read(las)
+        self.header = self.las.header
+        self.x = np.asarray(self.las.x)
+        self.y = np.asarray(self.las.y)
+        self.z = np.asarray(self.las.z)
+        self._masks = {}
+        self._xy_index = None
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def xyz(self):
+        """(N x 3) array of the point coordinates."""
+        return np.column_stack((self.x, self.y, self.z))
+
+    @property
+    def stored_z(self):
+        """Heights as the integers stored in the file."""
+        return np.asarray(self.las.Z)
+
+    @property
+    def xy_index(self):
+        """KD-tree on the XY coordinates, built on first use."""
+        if self._xy_index is None:
+            self._xy_index = cKDTree(np.column_stack((self.x, self.y)))
+        return self._xy_index
+
+    @property
+    def stamp(self):
+        """Integers identifying the points, for the caches built from them.
+
+        File size and modification time, or for a LasData given in memory the point count
+        and the bounds of the stored coordinates.
+        """
+        if self.path is not None:
+            source = os.stat(self.path)
+            return np.array([source.st_size, source.st_mtime_ns], dtype=np.int64)
+        stamp = [len(self)]
+        if len(self):
+            for stored in (self.las.X, self.las.Y, self.las.Z):
+                stamp += [np.min(stored), np.max(stored)]
+        return np.array(stamp, dtype=np.int64)
+
+    def below(self, height):
+        """Mask of the points lower than height, computed once per height."""
+        key = ("below", height)
+        if key not in self._masks:
+            # Same comparison as las.z < height, done by laspy on the stored integers
+            self._masks[key] = np.asarray(self.las.z < height)
+        return self._masks[key]
+
+    def subset(self, mask):
+        """New dataset holding the points of the mask, with the same header."""
+        las = laspy.create(point_format=self.header.point_format, file_version=self.header.version)
+        las.header = copy.deepcopy(self.header)
+        las.points = self.las.points[mask]
+        return LasDataset(las)
+
+    def write(self, las_path):
+        self.las.write(las_path)
+
+
+def as_dataset(las):
+    """Returns las as a LasDataset, decoding it only when a path or LasData is given."""
+    if isinstance(las, LasDataset):
+        return las
+    return LasDataset(las)
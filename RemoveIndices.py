@@ -1,24 +1,25 @@
-import laspy
 import numpy as np
+from LasDataset import as_dataset
+from CanopyExtraction import stem_keep_mask
 
 
 def func_remove_indices(las_path, indices_to_remove, combined_deletion, tree_crown_las):
-    las = laspy.read(las_path)
+    """Writes the points outside the stem cylinders to tree_crown_las and returns them as a LasDataset.
+
+    las_path is the input LAS path or its already decoded LasDataset; combined_deletion holds
+    the stems found by extracting_tree_crown_points, indices_to_remove the outliers among them.
+    """
+    dataset = as_dataset(las_path)
 
     for i in indices_to_remove:
         del combined_deletion[i]
     print('Outliers deleted')
 
-    combined_deletion_mask = np.ones(len(las.x), dtype=bool)
-    for mask in combined_deletion:
-        combined_deletion_mask &= mask
+    combined_deletion_mask = stem_keep_mask(dataset, combined_deletion)
 
-    cropped_las = laspy.create(point_format=las.header.point_format, file_version=las.header.version)
-    cropped_las.header = las.header
-    for dim in las.point_format.dimension_names:
-        if hasattr(las, dim):
-            setattr(cropped_las, dim, getattr(las, dim)[combined_deletion_mask])
+    cropped_las = dataset.subset(combined_deletion_mask)
     cropped_las.write(tree_crown_las)
 
     print("Remaining after mask:", np.sum(combined_deletion_mask))
 
+    return cropped_las
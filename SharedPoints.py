@@ -0,0 +1,73 @@
+import contextlib
+import multiprocessing
+import os
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+# Shared memory blocks attached inside the current (worker) process, by name
+_attached_stores = {}
+
+
+class SharedPointStore:
+    """Publishes a point array once in shared memory so pool workers can attach to it by name."""
+
+    def __init__(self, points, order=None):
+        # With an order, the rows are gathered straight into shared memory in that order
+        points = np.asarray(points)
+        self.shape = points.shape
+        self.dtype = points.dtype.str
+        self.shm = shared_memory.SharedMemory(create=True, size=max(points.nbytes, 1))
+        self.points = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        if order is None:
+            self.points[...] = points
+        else:
+            np.take(points, order, axis=0, out=self.points)
+
+    @property
+    def descriptor(self):
+        """Small picklable handle that is sent to the workers instead of the points."""
+        return self.shm.name, self.shape, self.dtype
+
+    def close(self):
+        self.points = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_points(descriptor):
+    """Returns the shared point array of a descriptor, attaching to it once per process."""
+    name, shape, dtype = descriptor
+    if name not in _attached_stores:
+        # Only keep the most recent store attached
+        for old_name in list(_attached_stores):
+            old_shm, old_points = _attached_stores.pop(old_name)
+            del old_points
+            old_shm.close()
+        shm = shared_memory.SharedMemory(name=name)
+        _attached_stores[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached_stores[name][1]
+
+
+def worker_pool(processes=None):
+    """Process pool whose workers can attach to the SharedPointStores of this process."""
+    # Workers must share the parent's resource tracker, otherwise each of them
+    # unlinks the shared point buffer when it exits
+    if os.name == "posix":
+        resource_tracker.ensure_running()
+    return multiprocessing.Pool(processes)
+
+
+@contextlib.contextmanager
+def shared_point_pool(points, processes=None, order=None):
+    """Publishes the points (in order, if given) and opens a worker pool, both released on exit.
+
+    Yields (store, pool); tasks send store.descriptor and the workers call attach_points.
+    """
+    with SharedPointStore(points, order) as store, worker_pool(processes) as pool:
+        yield store, pool
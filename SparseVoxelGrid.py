@@ -0,0 +1,107 @@
+import numpy as np
+
+# Bits used per axis when packing (i, j, k) into one int64 lookup key
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+# Face neighbours of a voxel
+FACE_NEIGHBOURS = np.array([
+    (-1, 0, 0),
+    (1, 0, 0),
+    (0, -1, 0),
+    (0, 1, 0),
+    (0, 0, -1),
+    (0, 0, 1),
+], dtype=np.int32)
+
+
+def pack_grid_indices(grid_indices):
+    """Packs (i, j, k) voxel indices into int64 keys (21 bits per axis)."""
+    shifted = np.asarray(grid_indices, dtype=np.int64) + KEY_OFFSET
+    return (shifted[:, 0] << (2 * KEY_BITS)) | (shifted[:, 1] << KEY_BITS) | shifted[:, 2]
+
+
+class SparseVoxelGrid:
+    """Occupied voxels of one voxel size, stored as NumPy columns.
+
+    grid_indices holds the int32 (i, j, k) index of every voxel relative to origin,
+    and attributes maps a column name (e.g. "count", "class") to one value per voxel.
+    """
+
+    def __init__(self, grid_indices, origin, voxel_size, attributes=None):
+        self.grid_indices = np.asarray(grid_indices, dtype=np.int32).reshape(-1, 3)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.voxel_size = float(voxel_size)
+        self.attributes = {}
+        for name, values in (attributes or {}).items():
+            self[name] = values
+        self._sorted_keys = None
+        self._key_order = None
+
+    def __len__(self):
+        return len(self.grid_indices)
+
+    def __getitem__(self, name):
+        return self.attributes[name]
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values)
+        if len(values) != len(self.grid_indices):
+            raise ValueError(f"Attribute {name} has {len(values)} values for {len(self.grid_indices)} voxels")
+        self.attributes[name] = values
+
+    @property
+    def centers(self):
+        """Center coordinate of every voxel."""
+        return self.origin + (self.grid_indices + 0.5) * self.voxel_size
+
+    def lookup(self, grid_indices):
+        """Returns the row of every (i, j, k) index, or -1 where the voxel is not occupied."""
+        if self._sorted_keys is None:
+            keys = pack_grid_indices(self.grid_indices)
+            self._key_order = np.argsort(keys, kind="stable")
+            self._sorted_keys = keys[self._key_order]
+
+        rows = np.full(len(grid_indices), -1, dtype=np.int64)
+        if len(self._sorted_keys) == 0:
+            return rows
+        keys = pack_grid_indices(grid_indices)
+        position = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        found = self._sorted_keys[position] == keys
+        rows[found] = self._key_order[position[found]]
+        return rows
+
+    def neighbours(self, rows=None, offsets=FACE_NEIGHBOURS):
+        """Returns a (len(rows) x len(offsets)) array with the row of every neighbour, -1 if empty."""
+        grid_indices = self.grid_indices if rows is None else self.grid_indices[rows]
+        neighbour_indices = (grid_indices[:, None, :].astype(np.int64) + offsets).reshape(-1, 3)
+        return self.lookup(neighbour_indices).reshape(len(grid_indices), len(offsets))
+
+    def select(self, mask):
+        """Returns a new grid with only the voxels where mask is True."""
+        return SparseVoxelGrid(self.grid_indices[mask], self.origin, self.voxel_size,
+                               {name: values[mask] for name, values in self.attributes.items()})
+
+    def filter_class(self, voxel_class, column="class"):
+        """Returns the voxels whose class column equals voxel_class."""
+        return self.select(self.attributes[column] == voxel_class)
+
+    def save(self, npz_path):
+        """Stores the grid as a compressed .npz file."""
+        columns = {"attr_" + name: values for name, values in self.attributes.items()}
+        np.savez_compressed(npz_path, grid_indices=self.grid_indices, origin=self.origin,
+                            voxel_size=self.voxel_size, **columns)
+
+    def save_csv(self, csv_path):
+        """Writes one row per voxel with its index, center and attribute columns (a sidecar table)."""
+        columns = [self.grid_indices, self.centers] + [np.asarray(values).reshape(len(self), -1) for values in self.attributes.values()]
+        names = ["i", "j", "k", "x", "y", "z"] + list(self.attributes)
+        formats = ["%d"] * 3 + ["%.6f"] * 3 + ["%d" if np.issubdtype(values.dtype, np.integer) else "%.9g" for values in self.attributes.values()]
+        np.savetxt(csv_path, np.hstack(columns), fmt=formats, delimiter=",", header=",".join(names), comments="")
+
+    @classmethod
+    def load(cls, npz_path):
+        """Reads a grid stored with save."""
+        with np.load(npz_path) as data:
+            attributes = {name[len("attr_"):]: data[name] for name in data.files if name.startswith("attr_")}
+            return cls(data["grid_indices"], data["origin"], float(data["voxel_size"]), attributes)
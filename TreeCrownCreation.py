@@ -1,12 +1,18 @@
-import open3d as o3d
 import numpy as np
 import trimesh
-import laspy
+from scipy.spatial import QhullError, cKDTree
+from LasDataset import as_dataset
+from SharedPoints import attach_points, shared_point_pool
+from VoxelMeshWriter import write_obj_blocks
 
 def las_to_ply(las_path, ply_path):
-    # Read LAS file
-    las = laspy.read(las_path)
-    points = np.vstack((las.x, las.y, las.z)).transpose()
+    # Open3D is only needed for this optional export
+    import open3d as o3d
+
+    # Read LAS file, unless a decoded LasDataset is given
+    dataset = as_dataset(las_path)
+    las = dataset.las
+    points = dataset.xyz
 
     # Optional: get color if available
     has_color = hasattr(las, "red") and hasattr(las, "green") and hasattr(las, "blue")
@@ -28,19 +34,98 @@ def las_to_ply(las_path, ply_path):
     # print(f"Saved PLY to {ply_path}")
 
 
-def func_TreeCrownCreation(las_path, ply_path, output_high_points_obj):
-
-    las_to_ply(las_path, ply_path)
-
-    # Load the point cloud
-    point_cloud = o3d.io.read_point_cloud(ply_path)
+def assign_to_stems(points, stems):
+    """Index of the stem nearest in XY to every point; a stem starts with its center_x, center_y."""
+    centers = np.asarray(stems, dtype=np.float64)[:, :2]
+    return cKDTree(centers).query(points[:, :2])[1]
+
+def tree_hull(points):
+    """Vertices, triangles, volume and area of the convex hull of the points.
+
+    None below 4 points or when the points have no volume (duplicates, collinear or
+    coplanar), so that such a tree gets a zero row instead of stopping the run.
+    """
+    if len(points) < 4 or np.linalg.matrix_rank(points - points.mean(axis=0)) < 3:
+        return None
+    try:
+        hull = trimesh.Trimesh(vertices=points).convex_hull
+    except QhullError:
+        # Nearly flat points that Qhull still cannot wrap
+        return None
+    return hull.vertices, hull.faces, hull.volume, hull.area
+
+def _tree_hull_task(task):
+    # Runs in a pool worker: hull of the crown points of one tree, a run of the shared buffer
+    descriptor, start, stop = task
+    return tree_hull(np.array(attach_points(descriptor)[start:stop]))
+
+def tree_hulls(points, trees, num_trees, processes=1):
+    """tree_hull of the points of every tree (0 to num_trees - 1), in tree order.
+
+    With processes other than 1 the points are published once in shared memory, grouped
+    by tree, and every hull is computed by a pool worker.
+    """
+    order = np.argsort(trees, kind="stable")
+    bounds = np.searchsorted(trees[order], np.arange(num_trees + 1))
+    if processes == 1:
+        return [tree_hull(points[order[start:stop]]) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    with shared_point_pool(points, processes, order) as (store, pool):
+        tasks = [(store.descriptor, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        return pool.map(_tree_hull_task, tasks)
+
+def write_tree_hulls(hulls, output_obj_path):
+    """Writes every hull as its own object (tree_<i>) of one OBJ file."""
+    with open(output_obj_path, 'w', buffering=1 << 20) as obj_file:
+        vertex_offset = 0
+        for i, hull in enumerate(hulls):
+            if hull is None:
+                continue
+            vertices, faces = hull[0], hull[1]
+            obj_file.write(f"o tree_{i}\n")
+            write_obj_blocks(obj_file, vertices, faces, vertex_offset)
+            vertex_offset += len(vertices)
+
+def save_tree_summary(stems, trees, hulls, csv_path):
+    """Writes one row per tree with its stem center, crown point count and hull volume, area and height (0 without a hull)."""
+    counts = np.bincount(trees, minlength=len(hulls))
+    rows = []
+    for i, hull in enumerate(hulls):
+        volume, area, height = (0.0, 0.0, 0.0) if hull is None else (hull[2], hull[3], np.ptp(hull[0][:, 2]))
+        rows.append((i, stems[i][0], stems[i][1], counts[i], volume, area, height))
+    np.savetxt(csv_path, np.array(rows, dtype=np.float64).reshape(-1, 7), fmt=["%d", "%.6f", "%.6f", "%d", "%.9g", "%.9g", "%.9g"],
+               delimiter=",", header="tree,center_x,center_y,points,volume,area,height", comments="")
+
+def tree_crowns(points, stems, output_high_points_obj, processes=1, summary_csv_path=None):
+    """One convex hull per tree, the crown points split by their nearest stem."""
+    trees = assign_to_stems(points, stems)
+    hulls = tree_hulls(points, trees, len(stems), processes)
+    write_tree_hulls(hulls, output_high_points_obj)
+    print(f"Saved {sum(hull is not None for hull in hulls)} tree crown hulls to {output_high_points_obj}")
+
+    if summary_csv_path is not None:
+        save_tree_summary(stems, trees, hulls, summary_csv_path)
+        print(f"Saved tree crown summary to {summary_csv_path}")
+
+def func_TreeCrownCreation(las_path, ply_path, output_high_points_obj, stems=None, processes=1, summary_csv_path=None):
+    """Convex hull of the tree crown points, written as OBJ.
+
+    With the stems found by extracting_tree_crown_points (the DBSCAN clusters kept after
+    func_remove_indices), every tree gets its own hull object, computed on processes
+    workers, and summary_csv_path receives the volume, area and height of every hull.
+    """
+
+    # The hull is built from the decoded points; the PLY copy is only written when ply_path is given
+    dataset = as_dataset(las_path)
+    if ply_path is not None:
+        las_to_ply(dataset, ply_path)
 
     # Convert point cloud to numpy array
-    points = np.asarray(point_cloud.points)
+    points = dataset.xyz
 
-    # Create a new point cloud with high points
-    high_point_cloud = o3d.geometry.PointCloud()
-    high_point_cloud.points = o3d.utility.Vector3dVector(points)
+    if stems:
+        tree_crowns(points, stems, output_high_points_obj, processes, summary_csv_path)
+        return
 
     # Create a convex hull from the high points if there are enough points
     if len(points) >= 3:  # Ensure there are enough points for a convex hull
@@ -0,0 +1,443 @@
+import laspy
+import os
+import numpy as np
+from SharedPoints import SharedPointStore, attach_points, worker_pool
+
+# Per-voxel aggregates of the statistics engine
+VOXEL_STATISTICS = ("count", "sum", "mean", "min", "max", "var")
+
+
+def voxel_grid_indices(points, voxel_size, origin):
+    """Returns the integer (i, j, k) voxel index of every point."""
+    return np.floor((points[:, :3] - origin) / voxel_size).astype(np.int64)
+
+
+def linear_voxel_keys(grid_indices):
+    """Packs (i, j, k) voxel indices into one int64 key per point."""
+    # Shift the indices so that they start at zero and flatten them row-major
+    min_index = grid_indices.min(axis=0)
+    shifted = grid_indices - min_index
+    dims = shifted.max(axis=0) + 1
+    keys = np.ravel_multi_index((shifted[:, 0], shifted[:, 1], shifted[:, 2]), dims)
+    return keys, min_index, dims
+
+
+def unpack_voxel_keys(keys, min_index, dims):
+    """Turns linear voxel keys back into (i, j, k) voxel indices."""
+    return np.column_stack(np.unravel_index(keys, dims)).astype(np.int64) + min_index
+
+
+def voxel_centers(grid_indices, voxel_size, origin):
+    """Returns the center coordinate of every voxel index."""
+    return np.asarray(origin) + (grid_indices + 0.5) * voxel_size
+
+
+def _count_groups(inverse, num_voxels, labels=None, label_values=()):
+    # Points and per-label points of every voxel, from the voxel of every point
+    totals = np.bincount(inverse, minlength=num_voxels)
+    label_counts = np.zeros((num_voxels, len(label_values)), dtype=np.int64)
+    for column, value in enumerate(label_values):
+        label_counts[:, column] = np.bincount(inverse, weights=(labels == value), minlength=num_voxels)
+    return totals, label_counts
+
+
+def group_voxel_counts(grid_indices, labels=None, label_values=()):
+    """Groups per-point voxel indices and counts the points (and labels) of every occupied voxel."""
+    keys, min_index, dims = linear_voxel_keys(grid_indices)
+
+    # Group the points by voxel key
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    totals, label_counts = _count_groups(inverse, len(unique_keys), labels, label_values)
+
+    return unpack_voxel_keys(unique_keys, min_index, dims), totals, label_counts
+
+
+def group_voxel_statistics(inverse, num_voxels, columns, statistics):
+    """Aggregates point columns per voxel with grouped reductions.
+
+    columns maps a dimension name to one value per point and statistics maps the same
+    names to the aggregates wanted (see VOXEL_STATISTICS). Returns a dict with one
+    per-voxel array per "<name>_<statistic>". Every voxel must hold at least one point.
+    """
+    counts = np.bincount(inverse, minlength=num_voxels)
+    order = None
+    results = {}
+
+    for name, wanted in statistics.items():
+        unknown = set(wanted) - set(VOXEL_STATISTICS)
+        if unknown:
+            raise ValueError(f"Unknown voxel statistics for {name}: {sorted(unknown)}")
+        values = np.asarray(columns[name], dtype=np.float64)
+
+        if "count" in wanted:
+            results[name + "_count"] = counts
+        if {"sum", "mean", "var"} & set(wanted):
+            sums = np.bincount(inverse, weights=values, minlength=num_voxels)
+            means = sums / counts
+        if "sum" in wanted:
+            results[name + "_sum"] = sums
+        if "mean" in wanted:
+            results[name + "_mean"] = means
+        if "var" in wanted:
+            # Deviations from the voxel mean rather than a sum of squares, for numerical stability
+            deviations = values - means[inverse]
+            results[name + "_var"] = np.bincount(inverse, weights=deviations * deviations, minlength=num_voxels) / counts
+        if {"min", "max"} & set(wanted):
+            # Points sorted once by voxel, then reduced per run of equal voxels
+            if order is None:
+                order = np.argsort(inverse, kind="stable")
+                starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sorted_values = values[order]
+            if "min" in wanted:
+                results[name + "_min"] = np.minimum.reduceat(sorted_values, starts)
+            if "max" in wanted:
+                results[name + "_max"] = np.maximum.reduceat(sorted_values, starts)
+
+    return results
+
+
+def partial_voxel_statistics(statistics):
+    """Aggregates to compute per chunk of points so that the wanted statistics can be merged exactly.
+
+    Counts come from the voxel totals, means from the merged sums, and variances are
+    merged from the per-chunk variances, sums and totals (see merge_voxel_counts).
+    """
+    partial = {}
+    for name, wanted in statistics.items():
+        unknown = set(wanted) - set(VOXEL_STATISTICS)
+        if unknown:
+            raise ValueError(f"Unknown voxel statistics for {name}: {sorted(unknown)}")
+        needed = set(wanted) & {"min", "max", "var"}
+        if {"sum", "mean", "var"} & set(wanted):
+            needed.add("sum")
+        partial[name] = [statistic for statistic in VOXEL_STATISTICS if statistic in needed]
+    return partial
+
+
+def finish_voxel_statistics(totals, partial, statistics):
+    """Turns merged partial statistics into the "<name>_<statistic>" arrays of group_voxel_statistics."""
+    results = {}
+    for name, wanted in statistics.items():
+        if "count" in wanted:
+            results[name + "_count"] = totals
+        if "sum" in wanted:
+            results[name + "_sum"] = partial[name + "_sum"]
+        if "mean" in wanted:
+            results[name + "_mean"] = partial[name + "_sum"] / totals
+        for statistic in ("var", "min", "max"):
+            if statistic in wanted:
+                results[name + "_" + statistic] = partial[name + "_" + statistic]
+    return results
+
+
+def _merge_partial_statistics(inverse, num_voxels, totals, merged_totals, partials):
+    # Merges the partial statistics dicts of several parts, row i of the parts going to voxel inverse[i]
+    merged = {}
+    order = None
+    for key in partials[0]:
+        values = np.concatenate([partial[key] for partial in partials])
+        name, statistic = key.rsplit("_", 1)
+        if statistic == "sum":
+            merged[key] = np.bincount(inverse, weights=values, minlength=num_voxels)
+        elif statistic in ("min", "max"):
+            # Rows sorted once by voxel, then reduced per run of equal voxels
+            if order is None:
+                order = np.argsort(inverse, kind="stable")
+                starts = np.searchsorted(inverse[order], np.arange(num_voxels))
+            reduce = np.minimum if statistic == "min" else np.maximum
+            merged[key] = reduce.reduceat(values[order], starts)
+        elif statistic == "var":
+            # Squared deviations of every part plus its count times the squared offset of its mean (Chan et al.)
+            sums = np.concatenate([partial[name + "_sum"] for partial in partials])
+            merged_means = np.bincount(inverse, weights=sums, minlength=num_voxels) / merged_totals
+            offsets = sums / totals - merged_means[inverse]
+            merged[key] = np.bincount(inverse, weights=totals * (values + offsets * offsets), minlength=num_voxels) / merged_totals
+    return merged
+
+
+def count_points_per_voxel(points, voxel_size, origin, labels=None, label_values=()):
+    """Bins every point into its voxel in one pass and counts the points per voxel.
+
+    Returns the occupied voxel indices, the total number of points per voxel and,
+    when labels are given, a (voxels x len(label_values)) array of per-label counts.
+    """
+    return group_voxel_counts(voxel_grid_indices(points, voxel_size, origin), labels, label_values)
+
+
+def count_points_with_statistics(points, voxel_size, origin, columns, statistics, labels=None, label_values=()):
+    """count_points_per_voxel that also aggregates point columns per voxel in the same grouping pass.
+
+    Returns the voxel indices, totals and label counts, plus the dict of group_voxel_statistics.
+    """
+    keys, min_index, dims = linear_voxel_keys(voxel_grid_indices(points, voxel_size, origin))
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    totals, label_counts = _count_groups(inverse, len(unique_keys), labels, label_values)
+    voxel_statistics = group_voxel_statistics(inverse, len(unique_keys), columns, statistics)
+    return unpack_voxel_keys(unique_keys, min_index, dims), totals, label_counts, voxel_statistics
+
+
+def aggregate_voxel_counts(grid_indices, totals, label_counts, factor):
+    """Merges the counts of a voxel level into a level that is factor times coarser."""
+    coarse_indices = np.floor_divide(grid_indices, factor)
+    return merge_voxel_counts([(coarse_indices, totals, label_counts)])
+
+
+def pyramid_quantum(voxel_sizes, resolution=0.001):
+    """Largest length (a multiple of resolution) that divides every voxel size."""
+    steps = np.round(np.asarray(voxel_sizes) / resolution).astype(np.int64)
+    return int(np.gcd.reduce(steps)) * resolution
+
+
+def count_points_pyramid(points, voxel_sizes, origin, labels=None, label_values=(), resolution=0.001):
+    """Counts the points per voxel for several voxel sizes from one binning pass.
+
+    The points are binned once into cells of the common quantum of all sizes, which
+    is the cached integer-quantized copy of the cloud. A size that is a whole multiple
+    of an already counted level is built by merging that level's voxels, otherwise it
+    is re-binned from the quantized cells. Every level shares the same origin so that
+    the levels nest exactly.
+    Returns a dict {voxel_size: (grid_indices, totals, label_counts)}.
+    """
+    quantum = pyramid_quantum(voxel_sizes, resolution)
+    quantized = group_voxel_counts(voxel_grid_indices(points, quantum, origin), labels, label_values)
+    counted = {1: quantized}
+
+    levels = {}
+    for voxel_size in sorted(voxel_sizes):
+        step = int(round(voxel_size / quantum))
+
+        # Coarsest already counted level that divides this one (the quantized cells always do)
+        parent_step = max(counted_step for counted_step in counted if step % counted_step == 0)
+        if step not in counted:
+            counted[step] = aggregate_voxel_counts(*counted[parent_step], step // parent_step)
+        levels[voxel_size] = counted[step]
+
+    return levels
+
+
+def merge_voxel_counts(parts):
+    """Merges partial (grid_indices, totals, label_counts) results into one count per voxel.
+
+    Parts may hold a fourth element, a dict of partial statistics (see partial_voxel_statistics),
+    which is merged per voxel as well.
+    """
+    grid_indices = np.concatenate([part[0] for part in parts])
+    totals = np.concatenate([part[1] for part in parts])
+    label_counts = np.concatenate([part[2] for part in parts])
+
+    keys, min_index, dims = linear_voxel_keys(grid_indices)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    merged_totals = np.bincount(inverse, weights=totals, minlength=len(unique_keys)).astype(np.int64)
+    merged_label_counts = np.zeros((len(unique_keys), label_counts.shape[1]), dtype=np.int64)
+    for column in range(label_counts.shape[1]):
+        merged_label_counts[:, column] = np.bincount(inverse, weights=label_counts[:, column], minlength=len(unique_keys))
+
+    merged = (unpack_voxel_keys(unique_keys, min_index, dims), merged_totals, merged_label_counts)
+    if len(parts[0]) > 3:
+        merged += (_merge_partial_statistics(inverse, len(unique_keys), totals, merged_totals, [part[3] for part in parts]),)
+    return merged
+
+
+def concatenate_voxel_counts(parts):
+    """Joins partial results that hold disjoint voxels (e.g. one per tile), without merging.
+
+    A fourth element of statistics dicts, as returned by count_points_with_statistics, is joined per key.
+    """
+    joined = tuple(np.concatenate([part[column] for part in parts]) for column in range(3))
+    if parts and len(parts[0]) > 3:
+        joined += ({name: np.concatenate([part[3][name] for part in parts]) for name in parts[0][3]},)
+    return joined
+
+
+def tile_point_order(points, voxel_size, origin, tile_voxels=256):
+    """Orders the points by XY tile of tile_voxels x tile_voxels voxels of the global lattice.
+
+    Returns the point order and the start of every tile in that order (one more entry than
+    tiles). Tile edges lie on voxel edges, so every voxel belongs to exactly one tile.
+    """
+    # Same floor as voxel_grid_indices, so a point's tile always agrees with its voxel
+    cells = np.floor((points[:, :2] - origin[:2]) / voxel_size).astype(np.int64) // tile_voxels
+    cells -= cells.min(axis=0)
+    tile_ids = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+
+    # Stable sort of small integers is a radix sort, linear in the number of points
+    if tile_ids.max() < np.iinfo(np.int16).max:
+        tile_ids = tile_ids.astype(np.int16)
+    order = np.argsort(tile_ids, kind="stable")
+    tile_starts = np.concatenate(([0], np.cumsum(np.bincount(tile_ids))))
+    return order, tile_starts
+
+
+def group_tiles(tile_starts, chunk_size):
+    """Packs consecutive tiles into (start, stop) point ranges of about chunk_size points."""
+    ranges = []
+    start = 0
+    for stop in tile_starts[1:]:
+        if stop - start >= chunk_size:
+            ranges.append((start, int(stop)))
+            start = int(stop)
+    if tile_starts[-1] > start:
+        ranges.append((start, int(tile_starts[-1])))
+    return ranges
+
+
+def las_sources_origin(las_paths, voxel_size):
+    """Lattice origin of a set of LAS files from their headers (min bound minus half a voxel, as Open3D)."""
+    mins = []
+    for las_path in las_paths:
+        with laspy.open(las_path) as reader:
+            mins.append(reader.header.mins)
+    return np.min(mins, axis=0) - voxel_size / 2
+
+
+def count_points_streaming(sources, voxel_size, origin, label_values=(), chunk_size=2_000_000, statistics=None):
+    """Counts the points per voxel while reading LAS files chunk by chunk.
+
+    sources is a list of (las_path, label) pairs; every point of a file gets that
+    label (None for unlabelled clouds). Only the per-voxel counters are kept, and
+    partial counts are merged once they outgrow the merged table, so memory is
+    bounded by the number of occupied voxels rather than the number of points.
+    With statistics (LAS dimension -> aggregates, see group_voxel_statistics) the
+    dict of per-voxel statistics is returned as a fourth element.
+    """
+    partial = None if not statistics else partial_voxel_statistics(statistics)
+    merged = None
+    pending = []
+    pending_rows = 0
+
+    for las_path, label in sources:
+        with laspy.open(las_path) as reader:
+            for points in reader.chunk_iterator(chunk_size):
+                if len(points) == 0:
+                    continue
+                chunk = np.vstack((points.x, points.y, points.z)).T
+                labels = np.full(len(chunk), label) if label is not None else None
+                if partial is None:
+                    part = count_points_per_voxel(chunk, voxel_size, origin, labels, label_values)
+                else:
+                    columns = {name: np.asarray(points[name], dtype=np.float64) for name in partial}
+                    part = count_points_with_statistics(chunk, voxel_size, origin, columns, partial, labels, label_values)
+                pending.append(part)
+                pending_rows += len(part[0])
+
+                if pending_rows > max(chunk_size, 0 if merged is None else len(merged[0])):
+                    merged = merge_voxel_counts(pending if merged is None else [merged] + pending)
+                    pending = []
+                    pending_rows = 0
+
+    if pending:
+        merged = merge_voxel_counts(pending if merged is None else [merged] + pending)
+    if partial is not None and merged is not None:
+        merged = merged[:3] + (finish_voxel_statistics(merged[1], merged[3], statistics),)
+    return merged
+
+
+def _count_point_range(task):
+    # Runs in a pool worker: bins one slice of the shared point buffer
+    descriptor, start, stop, voxel_size, origin, label_values = task
+    points = attach_points(descriptor)[start:stop]
+    labels = points[:, 3] if label_values else None
+    return count_points_per_voxel(points, voxel_size, origin, labels, label_values)
+
+
+def _count_point_range_statistics(task):
+    # Runs in a pool worker: bins one slice of the shared point buffer and aggregates its columns
+    descriptor, start, stop, voxel_size, origin, label_values, column_indices, statistics = task
+    points = attach_points(descriptor)[start:stop]
+    labels = points[:, 3] if label_values else None
+    columns = {name: points[:, column] for name, column in column_indices.items()}
+    return count_points_with_statistics(points, voxel_size, origin, columns, statistics, labels, label_values)
+
+
+class VoxelWorkerPool:
+    """Process pool that counts voxels on a point buffer published once in shared memory.
+
+    The pool and the published points are kept alive between calls, so the same
+    workers can be reused for every voxel size of a run. The points are split into
+    about four tasks per worker, of at most chunk_size points each.
+    """
+
+    def __init__(self, processes=None, chunk_size=2_000_000):
+        self.pool = worker_pool(processes)
+        self.processes = processes or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.store = None
+        self.store_key = None
+
+    def publish(self, key, points, order=None):
+        """Copies the points (in order, if given) into shared memory, unless the same key is already published."""
+        if self.store_key != key or self.store is None:
+            if self.store is not None:
+                self.store.close()
+            self.store = SharedPointStore(points, order)
+            self.store_key = key
+        return self.store
+
+    def task_size(self, num_points):
+        """Number of points per task, so that every worker gets several tasks."""
+        return max(1, min(self.chunk_size, -(-num_points // (4 * self.processes))))
+
+    def count_points_per_voxel(self, key, points, voxel_size, origin, label_values=()):
+        """Parallel version of count_points_per_voxel; labels are read from column 3 of the points."""
+        store = self.publish(key, points)
+        num_points = store.shape[0]
+        task_size = self.task_size(num_points)
+        tasks = [(store.descriptor, start, min(start + task_size, num_points), voxel_size, np.asarray(origin), tuple(label_values))
+                 for start in range(0, num_points, task_size)]
+        parts = self.pool.map(_count_point_range, tasks)
+        return merge_voxel_counts(parts)
+
+    def count_points_with_statistics(self, key, points, voxel_size, origin, column_indices, statistics, label_values=()):
+        """Parallel count_points_with_statistics on the columns at column_indices (name -> column).
+
+        Every worker aggregates its slice into mergeable partial statistics, which are
+        merged per voxel together with the counts.
+        """
+        store = self.publish(key, points)
+        num_points = store.shape[0]
+        task_size = self.task_size(num_points)
+        partial = partial_voxel_statistics(statistics)
+        tasks = [(store.descriptor, start, min(start + task_size, num_points), voxel_size, np.asarray(origin), tuple(label_values), column_indices, partial)
+                 for start in range(0, num_points, task_size)]
+        grid_indices, totals, label_counts, merged = merge_voxel_counts(self.pool.map(_count_point_range_statistics, tasks))
+        return grid_indices, totals, label_counts, finish_voxel_statistics(totals, merged, statistics)
+
+    def _tile_ranges(self, key, points, voxel_size, origin, tile_voxels):
+        # Publishes the points ordered by tile and returns the point ranges of whole tiles
+        order, tile_starts = tile_point_order(points, voxel_size, origin, tile_voxels)
+        store = self.publish((key, voxel_size, tile_voxels), points, order)
+        return store, group_tiles(tile_starts, self.task_size(len(points)))
+
+    def count_points_tiled(self, key, points, voxel_size, origin, label_values=(), tile_voxels=256):
+        """Counts the points per voxel with every voxel-aligned XY tile binned by one worker.
+
+        The points are published ordered by tile, and the workers get whole tiles, so their
+        results hold disjoint voxels and are joined without a merge pass.
+        """
+        origin = np.asarray(origin)
+        store, ranges = self._tile_ranges(key, points, voxel_size, origin, tile_voxels)
+        tasks = [(store.descriptor, start, stop, voxel_size, origin, tuple(label_values)) for start, stop in ranges]
+        parts = self.pool.map(_count_point_range, tasks)
+        return concatenate_voxel_counts(parts)
+
+    def count_points_tiled_with_statistics(self, key, points, voxel_size, origin, column_indices, statistics, label_values=(), tile_voxels=256):
+        """count_points_tiled that also aggregates per voxel the point columns at column_indices (name -> column)."""
+        origin = np.asarray(origin)
+        store, ranges = self._tile_ranges(key, points, voxel_size, origin, tile_voxels)
+        tasks = [(store.descriptor, start, stop, voxel_size, origin, tuple(label_values), column_indices, statistics) for start, stop in ranges]
+        parts = self.pool.map(_count_point_range_statistics, tasks)
+        return concatenate_voxel_counts(parts)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,358 @@
+import json
+import os
+import struct
+import numpy as np
+
+# Corners of a unit cube around its centroid, in the same order as create_voxel
+CUBE_CORNERS = np.array([
+    (-0.5, -0.5, -0.5),
+    (0.5, -0.5, -0.5),
+    (0.5, 0.5, -0.5),
+    (-0.5, 0.5, -0.5),
+    (-0.5, -0.5, 0.5),
+    (0.5, -0.5, 0.5),
+    (0.5, 0.5, 0.5),
+    (-0.5, 0.5, 0.5),
+])
+
+# Quad faces of the cube (zero-based indices into CUBE_CORNERS), wound counter-clockwise
+# seen from outside so that every writer gets outward normals
+CUBE_FACES = np.array([
+    (3, 2, 1, 0),
+    (4, 5, 6, 7),
+    (0, 4, 7, 3),
+    (2, 6, 5, 1),
+    (7, 6, 2, 3),
+    (0, 1, 5, 4),
+])
+
+# Outward normal of every CUBE_FACES quad
+CUBE_FACE_NORMALS = np.array([
+    (0, 0, -1),
+    (0, 0, 1),
+    (-1, 0, 0),
+    (1, 0, 0),
+    (0, 1, 0),
+    (0, -1, 0),
+])
+
+# Number of rows formatted at once by the OBJ writer
+OBJ_BLOCK_SIZE = 100_000
+
+# Number of cubes built at once when cubes are streamed to a file
+CUBE_CHUNK_SIZE = 250_000
+
+
+def cube_mesh_arrays(centers, size):
+    """Builds the vertices and zero-based quad faces of one cube per center."""
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    vertices = (centers[:, None, :] + CUBE_CORNERS * size).reshape(-1, 3)
+    faces = (CUBE_FACES[None, :, :] + 8 * np.arange(len(centers))[:, None, None]).reshape(-1, 4)
+    return vertices, faces
+
+
+def centers_to_grid_indices(centers, voxel_size):
+    """Recovers integer voxel indices and the lattice origin from voxel centers."""
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    reference = centers.min(axis=0) if len(centers) else np.zeros(3)
+    grid_indices = np.round((centers - reference) / voxel_size).astype(np.int64)
+    return grid_indices, reference - voxel_size / 2
+
+
+def _lattice_keys(lattice, dims):
+    return np.ravel_multi_index((lattice[:, 0], lattice[:, 1], lattice[:, 2]), dims)
+
+
+def _merge_runs(layer, u, v, length_u):
+    # Merges rectangles of height 1 (along v) that continue each other along v
+    order = np.lexsort((v, length_u, u, layer))
+    layer, u, v, length_u = layer[order], u[order], v[order], length_u[order]
+    starts = np.ones(len(layer), dtype=bool)
+    starts[1:] = (layer[1:] != layer[:-1]) | (u[1:] != u[:-1]) | (length_u[1:] != length_u[:-1]) | (v[1:] != v[:-1] + 1)
+    start_index = np.flatnonzero(starts)
+    length_v = np.diff(np.append(start_index, len(layer)))
+    return layer[start_index], u[start_index], v[start_index], length_u[start_index], length_v
+
+
+def _merge_faces(layer, u, v):
+    # First joins neighbouring faces along u into runs, then stacks equal runs along v
+    order = np.lexsort((u, v, layer))
+    layer, u, v = layer[order], u[order], v[order]
+    starts = np.ones(len(layer), dtype=bool)
+    starts[1:] = (layer[1:] != layer[:-1]) | (v[1:] != v[:-1]) | (u[1:] != u[:-1] + 1)
+    start_index = np.flatnonzero(starts)
+    length_u = np.diff(np.append(start_index, len(layer)))
+    return _merge_runs(layer[start_index], u[start_index], v[start_index], length_u)
+
+
+def voxel_surface_mesh_arrays(grid_indices, voxel_size, origin, greedy=False):
+    """Builds the outer surface of a set of voxels as a quad mesh.
+
+    Faces shared by two occupied voxels are dropped. With greedy=True coplanar
+    neighbouring faces are also merged into larger rectangles. Vertices are shared
+    between quads and faces are wound so that their normals point outwards.
+    """
+    grid_indices = np.asarray(grid_indices, dtype=np.int64).reshape(-1, 3)
+    if len(grid_indices) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 4), dtype=np.int64)
+
+    # Pad by one voxel so that every neighbour has a valid key
+    min_index = grid_indices.min(axis=0) - 1
+    shifted = grid_indices - min_index
+    dims = shifted.max(axis=0) + 2
+    occupied = np.sort(_lattice_keys(shifted, dims))
+
+    corners = []
+    for normal in CUBE_FACE_NORMALS:
+        neighbour_keys = _lattice_keys(shifted + normal, dims)
+        position = np.minimum(np.searchsorted(occupied, neighbour_keys), len(occupied) - 1)
+        visible = shifted[occupied[position] != neighbour_keys]
+        if len(visible) == 0:
+            continue
+
+        axis = int(np.flatnonzero(normal)[0])
+        axis_u, axis_v = (axis + 1) % 3, (axis + 2) % 3
+        layer = visible[:, axis] + (1 if normal[axis] > 0 else 0)
+        u, v = visible[:, axis_u], visible[:, axis_v]
+        if greedy:
+            layer, u, v, length_u, length_v = _merge_faces(layer, u, v)
+        else:
+            length_u = length_v = np.ones(len(layer), dtype=np.int64)
+
+        # Rectangle corners in lattice coordinates, counter-clockwise around the normal
+        quad = np.zeros((len(layer), 4, 3), dtype=np.int64)
+        quad[:, :, axis] = layer[:, None]
+        quad[:, :, axis_u] = np.column_stack((u, u + length_u, u + length_u, u))
+        quad[:, :, axis_v] = np.column_stack((v, v, v + length_v, v + length_v))
+        if normal[axis] < 0:
+            quad = quad[:, ::-1, :]
+        corners.append(quad.reshape(-1, 3))
+
+    corners = np.concatenate(corners)
+    corner_keys = _lattice_keys(corners, dims + 1)
+    unique_keys, faces = np.unique(corner_keys, return_inverse=True)
+    lattice = np.column_stack(np.unravel_index(unique_keys, dims + 1))
+    vertices = np.asarray(origin) + (lattice + min_index) * voxel_size
+    return vertices, faces.reshape(-1, 4)
+
+
+def write_obj_blocks(obj_file, vertices, faces, vertex_offset=0):
+    """Writes vertices and faces (quads or triangles) to an open OBJ file in large formatted blocks."""
+    # Fixed micrometre precision formats much faster than the shortest float repr
+    for start in range(0, len(vertices), OBJ_BLOCK_SIZE):
+        block = vertices[start:start + OBJ_BLOCK_SIZE]
+        obj_file.write(("v %.6f %.6f %.6f\n" * len(block)) % tuple(block.ravel().tolist()))
+
+    # OBJ face indices are one-based
+    face_format = "f" + " %d" * faces.shape[1] + "\n"
+    for start in range(0, len(faces), OBJ_BLOCK_SIZE):
+        block = faces[start:start + OBJ_BLOCK_SIZE] + vertex_offset + 1
+        obj_file.write((face_format * len(block)) % tuple(block.ravel().tolist()))
+
+
+def write_obj(vertices, faces, output_path):
+    """Writes a quad mesh as an OBJ file."""
+    with open(output_path, 'w', buffering=1 << 20) as obj_file:
+        write_obj_blocks(obj_file, vertices, faces)
+
+
+def _ply_header(num_vertices, num_faces):
+    return (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {num_vertices}\n"
+        "property double x\n"
+        "property double y\n"
+        "property double z\n"
+        f"element face {num_faces}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    ).encode("ascii")
+
+
+def _ply_face_records(faces):
+    face_records = np.empty(len(faces), dtype=[("count", "u1"), ("indices", "<i4", (faces.shape[1],))])
+    face_records["count"] = faces.shape[1]
+    face_records["indices"] = faces
+    return face_records
+
+
+def write_ply(vertices, faces, output_path):
+    """Writes a quad mesh as a binary little-endian PLY file with double precision vertices."""
+    with open(output_path, 'wb') as ply_file:
+        ply_file.write(_ply_header(len(vertices), len(faces)))
+        ply_file.write(np.ascontiguousarray(vertices, dtype="<f8").tobytes())
+        ply_file.write(_ply_face_records(faces).tobytes())
+
+
+def _pad4(data, pad_byte=b"\x00"):
+    return data + pad_byte * (-len(data) % 4)
+
+
+def write_glb(vertices, faces, output_path):
+    """Writes a quad mesh as a binary glTF (GLB) file.
+
+    glTF only stores float32 positions, so the vertices are written relative to their
+    minimum corner and that offset is put back as the node translation.
+    """
+    gltf = {"asset": {"version": "2.0"}, "scene": 0, "scenes": [{"nodes": []}]}
+    binary = b""
+
+    if len(vertices) > 0:
+        offset = vertices.min(axis=0)
+        positions = (vertices - offset).astype("<f4")
+        # Split every quad into two triangles
+        triangles = faces[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3).astype("<u4")
+
+        position_bytes = positions.tobytes()
+        index_bytes = triangles.tobytes()
+        binary = _pad4(position_bytes) + index_bytes
+
+        gltf["scenes"][0]["nodes"] = [0]
+        gltf["nodes"] = [{"mesh": 0, "translation": offset.tolist()}]
+        gltf["meshes"] = [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}]
+        gltf["buffers"] = [{"byteLength": len(_pad4(binary))}]
+        gltf["bufferViews"] = [
+            {"buffer": 0, "byteOffset": 0, "byteLength": len(position_bytes), "target": 34962},
+            {"buffer": 0, "byteOffset": len(_pad4(position_bytes)), "byteLength": len(index_bytes), "target": 34963},
+        ]
+        gltf["accessors"] = [
+            {"bufferView": 0, "componentType": 5126, "count": len(positions), "type": "VEC3",
+             "min": positions.min(axis=0).tolist(), "max": positions.max(axis=0).tolist()},
+            {"bufferView": 1, "componentType": 5125, "count": triangles.size, "type": "SCALAR"},
+        ]
+
+    write_glb_chunks(gltf, binary, output_path)
+
+
+def write_glb_chunks(gltf, binary, output_path):
+    """Packs a glTF JSON document and its binary buffer into a GLB container."""
+    json_chunk = _pad4(json.dumps(gltf, separators=(",", ":")).encode("utf-8"), b" ")
+    chunks = struct.pack("<I4s", len(json_chunk), b"JSON") + json_chunk
+    if binary:
+        binary = _pad4(binary)
+        chunks += struct.pack("<I4s", len(binary), b"BIN\x00") + binary
+
+    with open(output_path, 'wb') as glb_file:
+        glb_file.write(struct.pack("<4sII", b"glTF", 2, 12 + len(chunks)))
+        glb_file.write(chunks)
+
+
+def outward_cube_triangles():
+    """Triangles of the unit cube, wound so that their normals point outwards."""
+    return CUBE_FACES[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3)
+
+
+def write_instanced_cubes(centers, size, output_path):
+    """Writes one cube mesh plus one translation per center as a GLB file (EXT_mesh_gpu_instancing).
+
+    The viewer draws the cube once per translation, so the file holds 12 bytes per
+    center instead of a full cube. Translations are float32 relative to their minimum
+    corner, which is put back as the node translation.
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    gltf = {"asset": {"version": "2.0"}, "scene": 0, "scenes": [{"nodes": []}]}
+    binary = b""
+
+    if len(centers) > 0:
+        offset = centers.min(axis=0)
+        translations = (centers - offset).astype("<f4")
+        positions = (CUBE_CORNERS * size).astype("<f4")
+        triangles = outward_cube_triangles().astype("<u2")
+
+        views = [positions.tobytes(), triangles.tobytes(), translations.tobytes()]
+        view_offsets = []
+        for view in views:
+            view_offsets.append(len(binary))
+            binary += _pad4(view)
+
+        gltf["extensionsUsed"] = ["EXT_mesh_gpu_instancing"]
+        gltf["extensionsRequired"] = ["EXT_mesh_gpu_instancing"]
+        gltf["scenes"][0]["nodes"] = [0]
+        gltf["nodes"] = [{"mesh": 0, "translation": offset.tolist(),
+                          "extensions": {"EXT_mesh_gpu_instancing": {"attributes": {"TRANSLATION": 2}}}}]
+        gltf["meshes"] = [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}]
+        gltf["buffers"] = [{"byteLength": len(binary)}]
+        gltf["bufferViews"] = [
+            {"buffer": 0, "byteOffset": view_offsets[0], "byteLength": len(views[0]), "target": 34962},
+            {"buffer": 0, "byteOffset": view_offsets[1], "byteLength": len(views[1]), "target": 34963},
+            {"buffer": 0, "byteOffset": view_offsets[2], "byteLength": len(views[2])},
+        ]
+        gltf["accessors"] = [
+            {"bufferView": 0, "componentType": 5126, "count": len(positions), "type": "VEC3",
+             "min": positions.min(axis=0).tolist(), "max": positions.max(axis=0).tolist()},
+            {"bufferView": 1, "componentType": 5123, "count": triangles.size, "type": "SCALAR"},
+            {"bufferView": 2, "componentType": 5126, "count": len(translations), "type": "VEC3"},
+        ]
+
+    write_glb_chunks(gltf, binary, output_path)
+
+
+def write_mesh(vertices, faces, output_path):
+    """Writes a quad mesh in the format given by the file extension (.ply, .glb or .obj)."""
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == ".ply":
+        write_ply(vertices, faces, output_path)
+    elif extension == ".glb":
+        write_glb(vertices, faces, output_path)
+    elif extension == ".obj":
+        write_obj(vertices, faces, output_path)
+    else:
+        raise ValueError(f"Unsupported mesh format: {extension}")
+
+
+def write_cubes(centers, size, output_path, chunk_size=CUBE_CHUNK_SIZE):
+    """Writes one cube of the given size around every center (OBJ, binary PLY or GLB, from the extension).
+
+    OBJ and PLY files are written chunk_size cubes at a time, so memory stays bounded
+    for any number of centers. GLB needs the whole buffer and is built in one go.
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == ".obj":
+        with open(output_path, 'w', buffering=1 << 20) as obj_file:
+            for start in range(0, len(centers), chunk_size):
+                vertices, faces = cube_mesh_arrays(centers[start:start + chunk_size], size)
+                write_obj_blocks(obj_file, vertices, faces, 8 * start)
+    elif extension == ".ply":
+        # All vertices come before all faces, so the chunks are walked twice
+        with open(output_path, 'wb') as ply_file:
+            ply_file.write(_ply_header(8 * len(centers), 6 * len(centers)))
+            for start in range(0, len(centers), chunk_size):
+                vertices = (centers[start:start + chunk_size, None, :] + CUBE_CORNERS * size).reshape(-1, 3)
+                ply_file.write(vertices.astype("<f8").tobytes())
+            for start in range(0, len(centers), chunk_size):
+                count = len(centers[start:start + chunk_size])
+                faces = (CUBE_FACES[None, :, :] + 8 * np.arange(start, start + count)[:, None, None]).reshape(-1, 4)
+                ply_file.write(_ply_face_records(faces).tobytes())
+    elif extension == ".glb":
+        write_glb(*cube_mesh_arrays(centers, size), output_path)
+    else:
+        raise ValueError(f"Unsupported mesh format: {extension}")
+
+
+def write_voxel_mesh(centers, voxel_size, output_path, mesh_mode="cubes"):
+    """Writes the voxels as a single mesh file.
+
+    mesh_mode "cubes" writes one closed cube per voxel, "culled" drops the faces
+    shared by neighbouring voxels and "greedy" also merges coplanar faces.
+    """
+    if mesh_mode == "cubes":
+        write_cubes(centers, voxel_size, output_path)
+    elif mesh_mode in ("culled", "greedy"):
+        grid_indices, origin = centers_to_grid_indices(centers, voxel_size)
+        vertices, faces = voxel_surface_mesh_arrays(grid_indices, voxel_size, origin, greedy=mesh_mode == "greedy")
+        write_mesh(vertices, faces, output_path)
+    else:
+        raise ValueError(f"Unknown mesh mode: {mesh_mode}")
+
+
+def write_sparse_voxel_mesh(voxel_grid, output_path, mesh_mode="cubes"):
+    """Writes the voxels of a SparseVoxelGrid as a single mesh file."""
+    if mesh_mode == "cubes":
+        write_voxel_mesh(voxel_grid.centers, voxel_grid.voxel_size, output_path)
+    elif mesh_mode in ("culled", "greedy"):
+        vertices, faces = voxel_surface_mesh_arrays(voxel_grid.grid_indices, voxel_grid.voxel_size, voxel_grid.origin, greedy=mesh_mode == "greedy")
+        write_mesh(vertices, faces, output_path)
+    else:
+        raise ValueError(f"Unknown mesh mode: {mesh_mode}")
@@ -0,0 +1,141 @@
+import laspy
+import numpy as np
+from VoxelEngine import voxel_grid_indices
+
+# Largest number of cells of the dense block occupancy map used to skip empty space
+MAX_OCCUPANCY_BLOCKS = 1 << 24
+
+
+def sun_direction(azimuth, elevation):
+    """Unit vector pointing from the ground towards the sun (azimuth clockwise from north, in degrees)."""
+    azimuth = np.radians(azimuth)
+    elevation = np.radians(elevation)
+    return np.array([np.sin(azimuth) * np.cos(elevation), np.cos(azimuth) * np.cos(elevation), np.sin(elevation)])
+
+
+def traverse_rays(voxel_grid, points, directions, lengths):
+    """Walks every ray through the voxel grid with a 3D-DDA, all rays advancing together per NumPy step.
+
+    Ray r starts at points[r] and runs along the unit vector directions[r] for lengths[r]
+    (np.inf to leave the grid). Returns the number of times every voxel of the grid was
+    crossed by a ray, not counting the voxel each ray starts in.
+    """
+    passes = np.zeros(len(voxel_grid), dtype=np.int64)
+    if len(voxel_grid) == 0 or len(points) == 0:
+        return passes
+
+    voxel_size = voxel_grid.voxel_size
+    current = voxel_grid_indices(points, voxel_size, voxel_grid.origin)
+    step = np.sign(directions).astype(np.int64)
+    lengths = np.asarray(lengths, dtype=np.float64)
+
+    # Ray distance to the first voxel boundary on every axis, and between two boundaries
+    with np.errstate(divide="ignore", invalid="ignore"):
+        boundaries = voxel_grid.origin + (current + (step > 0)) * voxel_size
+        t_max = np.where(step != 0, (boundaries - points[:, :3]) / directions, np.inf)
+        t_delta = np.where(step != 0, voxel_size / np.abs(directions), np.inf)
+
+    # A ray that leaves the bounding box of the occupied voxels never crosses another one
+    low = voxel_grid.grid_indices.min(axis=0)
+    high = voxel_grid.grid_indices.max(axis=0)
+
+    # Dense map of the blocks of block x block x block voxels that hold an occupied voxel,
+    # so that only rays inside occupied blocks are looked up in the sparse grid
+    block = 1
+    while np.prod((high - low) // block + 1) > MAX_OCCUPANCY_BLOCKS:
+        block *= 2
+    occupied_blocks = np.zeros((high - low) // block + 1, dtype=bool)
+    occupied_blocks[tuple(((voxel_grid.grid_indices - low) // block).T)] = True
+
+    # Only the rays still inside the grid are kept, so every step works on compact arrays
+    crossed = []
+    crossed_count = 0
+    while len(current):
+        # Advance every ray into its next voxel along the axis with the nearest boundary
+        rays = np.arange(len(current))
+        axis = np.argmin(t_max, axis=1)
+        t = t_max[rays, axis]
+        current[rays, axis] += step[rays, axis]
+        t_max[rays, axis] += t_delta[rays, axis]
+
+        inside = (t < lengths) & np.all((current >= low) & (current <= high), axis=1)
+        if not inside.all():
+            current, step, t_max, t_delta, lengths = current[inside], step[inside], t_max[inside], t_delta[inside], lengths[inside]
+
+        blocks = (current - low) // block
+        candidates = occupied_blocks.ravel()[(blocks[:, 0] * occupied_blocks.shape[1] + blocks[:, 1]) * occupied_blocks.shape[2] + blocks[:, 2]]
+        rows = voxel_grid.lookup(current[candidates])
+        crossed.append(rows[rows >= 0])
+        crossed_count += len(crossed[-1])
+
+        # Count the crossed voxels once enough of them are collected, not on every step
+        if crossed_count > len(passes):
+            passes += np.bincount(np.concatenate(crossed), minlength=len(passes))
+            crossed = []
+            crossed_count = 0
+
+    if crossed:
+        passes += np.bincount(np.concatenate(crossed), minlength=len(passes))
+    return passes
+
+
+def count_ray_hits(voxel_grid, points, directions=None, scanner_positions=None, batch_size=200_000):
+    """Counts per voxel the rays that end in it (hits) and the rays that cross it (passes).
+
+    Every point casts one ray towards each sun direction and one towards each scanner
+    position; the voxel holding the point is hit, the occupied voxels between the point
+    and the source are passed through. Points are traced in batches to bound memory.
+    """
+    hits = np.zeros(len(voxel_grid), dtype=np.int64)
+    passes = np.zeros(len(voxel_grid), dtype=np.int64)
+    directions = np.zeros((0, 3)) if directions is None else np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    scanner_positions = np.zeros((0, 3)) if scanner_positions is None else np.asarray(scanner_positions, dtype=np.float64).reshape(-1, 3)
+
+    for start in range(0, len(points), batch_size):
+        batch = np.asarray(points[start:start + batch_size, :3], dtype=np.float64)
+        rows = voxel_grid.lookup(voxel_grid_indices(batch, voxel_grid.voxel_size, voxel_grid.origin))
+        batch = batch[rows >= 0]
+        rows = rows[rows >= 0]
+        num_sources = len(directions) + len(scanner_positions)
+        hits += num_sources * np.bincount(rows, minlength=len(hits))
+
+        for direction in directions:
+            ray_directions = np.broadcast_to(direction / np.linalg.norm(direction), batch.shape)
+            passes += traverse_rays(voxel_grid, batch, ray_directions, np.full(len(batch), np.inf))
+
+        for scanner_position in scanner_positions:
+            offsets = scanner_position - batch
+            lengths = np.linalg.norm(offsets, axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ray_directions = offsets / lengths[:, None]
+            # A point at the scanner position has no ray to trace
+            traced = lengths > 0
+            passes += traverse_rays(voxel_grid, batch[traced], ray_directions[traced], lengths[traced])
+
+    return hits, passes
+
+
+def count_ray_hits_streaming(voxel_grid, las_path, directions=None, scanner_positions=None, chunk_size=2_000_000):
+    """Same as count_ray_hits, reading the points from the LAS file chunk by chunk."""
+    hits = np.zeros(len(voxel_grid), dtype=np.int64)
+    passes = np.zeros(len(voxel_grid), dtype=np.int64)
+    with laspy.open(las_path) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            chunk = np.vstack((points.x, points.y, points.z)).T
+            chunk_hits, chunk_passes = count_ray_hits(voxel_grid, chunk, directions, scanner_positions)
+            hits += chunk_hits
+            passes += chunk_passes
+    return hits, passes
+
+
+def add_occlusion_attributes(voxel_grid, hits, passes):
+    """Stores the hits, passes and hit ratio (hits / (hits + passes)) of every voxel in the grid.
+
+    The hit ratio is a leaf area density proxy: 1 for a voxel that stops every ray
+    reaching it, close to 0 for a voxel that most rays cross.
+    """
+    voxel_grid["hits"] = hits.astype(np.int32)
+    voxel_grid["passes"] = passes.astype(np.int32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        voxel_grid["hit_ratio"] = np.where(hits + passes > 0, hits / (hits + passes), 0).astype(np.float32)
+    return voxel_grid
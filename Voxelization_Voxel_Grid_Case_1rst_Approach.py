@@ -1,85 +1,35 @@
 import laspy
 import open3d as o3d
 import numpy as np
-import multiprocessing
 import os
 from laspy import LasData, ExtraBytesParams
+from VoxelMeshWriter import write_sparse_voxel_mesh
+from VoxelEngine import count_points_per_voxel, count_points_with_statistics, count_points_pyramid, count_points_streaming, las_sources_origin
+from SparseVoxelGrid import SparseVoxelGrid
 
-# Create a voxel as a cube using the centroid
-def create_voxel(x, y, z, size):
-    half_size = size / 2
-    vertices = [
-        (x - half_size, y - half_size, z - half_size),
-        (x + half_size, y - half_size, z - half_size),
-        (x + half_size, y + half_size, z - half_size),
-        (x - half_size, y + half_size, z - half_size),
-        (x - half_size, y - half_size, z + half_size),
-        (x + half_size, y - half_size, z + half_size),
-        (x + half_size, y + half_size, z + half_size),
-        (x - half_size, y + half_size, z + half_size),
-    ]
-    faces = [
-        (1, 2, 3, 4),
-        (5, 6, 7, 8),
-        (1, 5, 8, 4),
-        (2, 6, 7, 3),
-        (4, 3, 7, 8),
-        (1, 2, 6, 5),
-    ]
-    return vertices, faces
+# Voxel classes, equal to the point labels of branches and leaves
+BRANCHES_CLASS = 1
+LEAVES_CLASS = 2
 
 def voxelize_las(las_point_cloud, voxel_size):
     """Converts LAS point cloud to a voxel grid."""
     points = np.vstack((las_point_cloud.x, las_point_cloud.y, las_point_cloud.z)).T
+    return voxelize_points(points, voxel_size)
+
+def voxelize_points(points, voxel_size):
+    """Converts an (N x 3+) point array to a voxel grid."""
     pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(points)
+    pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(points[:, :3]))
     return o3d.geometry.VoxelGrid.create_from_point_cloud(pcd, voxel_size)
 
-def process_voxel_combined(task):
-    x, y, z, voxel_size, points_array = task
-    half_size = voxel_size / 2
-    mask = (
-        (points_array[:, 0] >= x - half_size) & (points_array[:, 0] <= x + half_size) &
-        (points_array[:, 1] >= y - half_size) & (points_array[:, 1] <= y + half_size) &
-        (points_array[:, 2] >= z - half_size) & (points_array[:, 2] <= z + half_size)
-    )
-    labels = points_array[mask][:, 3]
-    num_points_branches = np.sum(labels == 1)
-    num_points_leaves = np.sum(labels == 2)
-    # print(f"PID {os.getpid()} processing voxel at ({x:.2f}, {y:.2f}, {z:.2f})")
-    return ((x, y, z), num_points_branches, num_points_leaves)
-
-
-def examine_voxel(las_point_cloud, voxel_grid, voxel_size, voxels_dict_branches, voxels_dict_leaves, num_points_branches_list, num_points_leaves_list, txt_file_path):
-    # Inside examine_voxel
-    remove_indices = []
-    tasks = []
-    points_array = np.vstack((las_point_cloud.x, las_point_cloud.y, las_point_cloud.z, las_point_cloud.label)).T
-
-    for voxel in voxel_grid.get_voxels():
-        grid_index_np = np.array(voxel.grid_index, dtype=np.int32)
-        x, y, z = voxel_grid.get_voxel_center_coordinate(grid_index_np)
-        tasks.append((x, y, z, voxel_size, points_array))
-
-    with multiprocessing.Pool() as pool:
-        results = pool.map(process_voxel_combined, tasks)
-
-    for (x, y, z), num_points_branches, num_points_leaves in results:
-        num_points_branches_list.append(num_points_branches)
-        num_points_leaves_list.append(num_points_leaves)
-        if num_points_branches == 0 and num_points_leaves == 0:
-            grid_index = voxel_grid.get_voxel(np.array([x, y, z]))
-            if grid_index is not None:
-                remove_indices.append(grid_index)
-
-    # Remove empty voxels from the grid
-    for idx in remove_indices:
-        voxel_grid.remove_voxel(idx)
-
-    sums = [x + y for x, y in zip(num_points_branches_list, num_points_leaves_list)]
-
-    max_number_points = max(sums)
-    min_number_points = min(sums)
+def classify_voxels(grid_indices, label_counts, voxel_size, origin, txt_file_path):
+    """Builds the sparse voxel grid with its branches/leaves class and writes the count log."""
+    num_points_branches = label_counts[:, 0]
+    num_points_leaves = label_counts[:, 1]
+    sums = num_points_branches + num_points_leaves
+
+    max_number_points = sums.max()
+    min_number_points = sums.min()
 
     with open(txt_file_path, 'w') as f:
         f.write("Voxel grid export log\n")
@@ -93,29 +43,77 @@ def examine_voxel(las_point_cloud, voxel_grid, voxel_size, voxels_dict_branches,
         f.write(line_1 + "\n")
         f.write(line_2 + "\n")
 
-    for (x, y, z), num_points_branches, num_points_leaves in results:
+    # A voxel belongs to the branches when it holds at least as many branch points as leaf points
+    voxel_class = np.where(num_points_branches >= num_points_leaves, BRANCHES_CLASS, LEAVES_CLASS)
+
+    return SparseVoxelGrid(grid_indices, origin, voxel_size, {
+        "count_branches": num_points_branches.astype(np.int32),
+        "count_leaves": num_points_leaves.astype(np.int32),
+        "class": voxel_class.astype(np.uint8),
+    })
+
+
+def examine_voxel(points_array, voxel_size, txt_file_path, counting="binned", worker_pool=None, points_key=None, statistics=None):
+    """Counts the branch and leaf points per voxel and classifies the voxels.
 
-        if num_points_branches >= num_points_leaves:
-            voxels_dict_branches[(x, y, z)] = (num_points_branches, num_points_leaves)
+    points_array holds the x, y, z and label columns, followed by one column per dimension of
+    statistics (see load_labelled_points). statistics maps those dimensions to the per-voxel
+    aggregates to compute in the same pass, stored as "<dimension>_<statistic>".
+    The voxels follow the lattice of an Open3D VoxelGrid of the points, without building the grid.
+    """
+    origin = points_array[:, :3].min(axis=0) - voxel_size / 2
+
+    voxel_statistics = {}
+    column_indices = {name: 4 + column for column, name in enumerate(statistics or ())}
+
+    # Every binned voxel holds at least one point, so no empty voxels have to be removed from the grid
+    if counting == "binned":
+        # Bin every point into its voxel once and count the labels per voxel
+        if statistics:
+            columns = {name: points_array[:, column] for name, column in column_indices.items()}
+            grid_indices, _, label_counts, voxel_statistics = count_points_with_statistics(points_array, voxel_size, origin, columns, statistics, points_array[:, 3], (1, 2))
+        else:
+            grid_indices, _, label_counts = count_points_per_voxel(points_array, voxel_size, origin, points_array[:, 3], (1, 2))
+    elif counting == "pool":
+        # Same binning, split over the worker pool that reads the points from shared memory
+        if statistics:
+            grid_indices, _, label_counts, voxel_statistics = worker_pool.count_points_with_statistics(points_key, points_array, voxel_size, origin, column_indices, statistics, (1, 2))
+        else:
+            grid_indices, _, label_counts = worker_pool.count_points_per_voxel(points_key, points_array, voxel_size, origin, (1, 2))
+    elif counting == "tiled":
+        # Voxel-aligned tiles binned in parallel by the workers
+        if statistics:
+            grid_indices, _, label_counts, voxel_statistics = worker_pool.count_points_tiled_with_statistics(points_key, points_array, voxel_size, origin, column_indices, statistics, (1, 2))
         else:
-            voxels_dict_leaves[(x, y, z)] = (num_points_branches, num_points_leaves)
+            grid_indices, _, label_counts = worker_pool.count_points_tiled(points_key, points_array, voxel_size, origin, (1, 2))
+    else:
+        raise ValueError(f"Unknown counting mode: {counting}")
 
-    return voxels_dict_branches, voxels_dict_leaves, num_points_branches_list, num_points_leaves_list, voxel_grid
+    sparse_voxel_grid = classify_voxels(grid_indices, label_counts, voxel_size, origin, txt_file_path)
+    for name, values in voxel_statistics.items():
+        sparse_voxel_grid[name] = values
+    return sparse_voxel_grid
 
 
-def generate_obj_voxel_from_dictionary(voxels_dict, voxel_size, output_obj_file_path):
-    """Writes voxelized output as an OBJ file."""
-    written_voxels = [create_voxel(center[0], center[1], center[2], voxel_size) for center in voxels_dict]
+def generate_obj_voxel_from_grid(voxel_grid, voxel_class, output_obj_file_path, mesh_mode="cubes"):
+    """Writes the voxels of one class as a mesh file (OBJ, binary PLY or GLB, from the file extension)."""
+    class_voxels = voxel_grid.filter_class(voxel_class)
+    write_sparse_voxel_mesh(class_voxels, output_obj_file_path, mesh_mode)
+    return len(class_voxels)
 
-    with open(output_obj_file_path, 'w') as obj_file:
-        vertex_index = 1
-        for vertices, faces in written_voxels:
-            for vertex in vertices:
-                obj_file.write(f"v {vertex[0]} {vertex[1]} {vertex[2]}\n")
-            for face in faces:
-                obj_file.write(f"f {face[0] + vertex_index - 1} {face[1] + vertex_index - 1} "
-                               f"{face[2] + vertex_index - 1} {face[3] + vertex_index - 1}\n")
-            vertex_index += 8  # Move to the next voxel
+def export_voxels(voxel_grid, voxel_classes, output_obj_file_paths, txt_file_path, mesh_mode="cubes"):
+    # Open the file
+    with open(txt_file_path, 'a') as f:
+        # Save refined voxels to OBJ
+        i = 1
+        j = 0
+        for voxel_class in voxel_classes:
+            num_voxels = generate_obj_voxel_from_grid(voxel_grid, voxel_class, output_obj_file_paths[j], mesh_mode)
+            line = f"Total voxels saved at voxels_dict_{i}: {num_voxels}"
+            # print(line)
+            f.write(line + "\n")
+            i += 1
+            j += 1
 
 def merge_las_files(output_path, input_path):
     # Open input files
@@ -124,12 +122,23 @@ def merge_las_files(output_path, input_path):
             for points in inlas.chunk_iterator(2_000_000):
                 outlas.append_points(points)
 
-def voxels_creation(branches_las_path, leaves_las_path, output_obj_file_path_branches, output_obj_file_path_leaves, voxel_size, txt_file_path):
-
-    # Read LAS file
+def labelled_points_array(las_branches, las_leaves, dimensions=()):
+    """Stacks branches (label 1) and leaves (label 2) into one x, y, z, label array, plus one column per extra LAS dimension."""
+    return np.vstack((
+        np.concatenate((las_branches.x, las_leaves.x)),
+        np.concatenate((las_branches.y, las_leaves.y)),
+        np.concatenate((las_branches.z, las_leaves.z)),
+        np.concatenate((np.full(len(las_branches.points), 1), np.full(len(las_leaves.points), 2))),
+    ) + tuple(np.concatenate((np.asarray(las_branches[name], dtype=np.float64), np.asarray(las_leaves[name], dtype=np.float64))) for name in dimensions)).T
+
+def load_labelled_points(branches_las_path, leaves_las_path, dimensions=()):
+    # Read LAS files
     las_branches = laspy.read(branches_las_path)
     las_leaves = laspy.read(leaves_las_path)
+    return labelled_points_array(las_branches, las_leaves, dimensions)
 
+def write_synthetic_las(las_branches, las_leaves, synthetic_las_path):
+    """Optional export of the labelled branches and leaves as one point format 0 LAS file."""
     # Create a new header with PointFormat(0)
     new_header = laspy.LasHeader(point_format=0, version="1.2")
     new_header.offsets = las_branches.header.offsets
@@ -162,10 +171,7 @@ def voxels_creation(branches_las_path, leaves_las_path, output_obj_file_path_bra
     new_leaves.add_extra_dim(label_dim)
     new_leaves["label"] = np.full(len(las_leaves.points), 2, dtype=np.uint16)
 
-    # Prepare output path
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    output_path = os.path.join(script_dir, "Output_Voxel_Grid_Case_1rst_Approach")
-    synthetic_las_path = os.path.join(output_path, "SyntheticLAS.las")
+    output_path = os.path.dirname(synthetic_las_path)
 
     # Write new_branches LAS to file
     with laspy.open(synthetic_las_path, mode='w', header=new_branches.header) as writer:
@@ -178,35 +184,64 @@ def voxels_creation(branches_las_path, leaves_las_path, output_obj_file_path_bra
 
     merge_las_files(synthetic_las_path, leaves_converted_path)
 
-    synthetic_las = laspy.read(synthetic_las_path)
-    labels = synthetic_las["label"]
-    print("Unique labels:", np.unique(labels, return_counts=True))
-
-    # Convert point cloud to a voxel grid with a specific voxel size
-    voxel_grid = voxelize_las(synthetic_las, voxel_size)
+def voxels_creation(branches_las_path, leaves_las_path, output_obj_file_path_branches, output_obj_file_path_leaves, voxel_size, txt_file_path, counting="binned", worker_pool=None, mesh_mode="cubes", points_array=None, export_synthetic_las=False, statistics=None):
+    """Voxelizes the branches and leaves and writes one mesh per class.
+
+    points_array, when given, must be loaded with load_labelled_points(..., list(statistics)).
+    With statistics (see examine_voxel), the voxel attributes are also written to a CSV table next to the log.
+    """
+
+    if counting == "streaming":
+        # Count straight from the LAS chunks, without loading the clouds or building the Open3D grid
+        origin = las_sources_origin([branches_las_path, leaves_las_path], voxel_size)
+        counts = count_points_streaming([(branches_las_path, 1), (leaves_las_path, 2)], voxel_size, origin, (1, 2), statistics=statistics)
+        grid_indices, _, label_counts = counts[:3]
+        sparse_voxel_grid = classify_voxels(grid_indices, label_counts, voxel_size, origin, txt_file_path)
+        if statistics:
+            for name, values in counts[3].items():
+                sparse_voxel_grid[name] = values
+            sparse_voxel_grid.save_csv(os.path.splitext(txt_file_path)[0] + ".csv")
+        export_voxels(sparse_voxel_grid, [LEAVES_CLASS, BRANCHES_CLASS], [output_obj_file_path_leaves, output_obj_file_path_branches], txt_file_path, mesh_mode)
+        return None
+
+    if points_array is None:
+        points_array = load_labelled_points(branches_las_path, leaves_las_path, list(statistics or ()))
+    print("Unique labels:", np.unique(points_array[:, 3], return_counts=True))
+
+    if export_synthetic_las:
+        # Prepare output path
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        output_path = os.path.join(script_dir, "Output_Voxel_Grid_Case_1rst_Approach")
+        write_synthetic_las(laspy.read(branches_las_path), laspy.read(leaves_las_path), os.path.join(output_path, "SyntheticLAS.las"))
 
     # Process voxels
-    voxels_dict_leaves = {}
-    voxels_dict_branches = {}
-    num_points_branches_list = []
-    num_points_leaves_list = []
-    voxels_dict_leaves, voxels_dict_branches, num_points_branches, num_points_leaves, voxel_grid = examine_voxel(synthetic_las, voxel_grid, voxel_size, voxels_dict_branches, voxels_dict_leaves, num_points_branches_list, num_points_leaves_list, txt_file_path)
+    sparse_voxel_grid = examine_voxel(points_array, voxel_size, txt_file_path, counting, worker_pool, (branches_las_path, leaves_las_path), statistics)
 
-    voxels_dict_list = [voxels_dict_leaves, voxels_dict_branches]
-    output_obj_file_paths = [output_obj_file_path_leaves, output_obj_file_path_branches]
+    if statistics:
+        sparse_voxel_grid.save_csv(os.path.splitext(txt_file_path)[0] + ".csv")
 
-    # Open the file
-    with open(txt_file_path, 'a') as f:
-        # Save refined voxels to OBJ
-        i = 1
-        j = 0
-        for voxels_dict in voxels_dict_list:
-            generate_obj_voxel_from_dictionary(voxels_dict, voxel_size, output_obj_file_paths[j])
-            line = f"Total voxels saved at voxels_dict_{i}: {len(voxels_dict)}"
-            # print(line)
-            f.write(line + "\n")
-            i += 1
-            j += 1
+    export_voxels(sparse_voxel_grid, [LEAVES_CLASS, BRANCHES_CLASS], [output_obj_file_path_leaves, output_obj_file_path_branches], txt_file_path, mesh_mode)
+
+    return None
+
+
+def voxels_creation_pyramid(branches_las_path, leaves_las_path, output_path, voxel_sizes, mesh_extension=".obj", mesh_mode="cubes"):
+    """Voxelizes the branches and leaves for every voxel size from one binning pass."""
+
+    # Read LAS files once and label branches with 1 and leaves with 2
+    points_array = load_labelled_points(branches_las_path, leaves_las_path)
+
+    # All sizes share the same lattice origin so that coarser levels are built from finer ones
+    origin = points_array[:, :3].min(axis=0)
+    levels = count_points_pyramid(points_array, voxel_sizes, origin, points_array[:, 3], (1, 2))
+
+    for voxel_size in voxel_sizes:
+        grid_indices, _, label_counts = levels[voxel_size]
+        output_obj_file_path_branches = os.path.join(output_path, "voxels_" + str(voxel_size) + "_branches" + mesh_extension)
+        output_obj_file_path_leaves = os.path.join(output_path, "voxels_" + str(voxel_size) + "_leaves" + mesh_extension)
+        txt_file_path = os.path.join(output_path, "voxel_counts_size_" + str(voxel_size) + "_m.txt")
 
+        sparse_voxel_grid = classify_voxels(grid_indices, label_counts, voxel_size, origin, txt_file_path)
+        export_voxels(sparse_voxel_grid, [LEAVES_CLASS, BRANCHES_CLASS], [output_obj_file_path_leaves, output_obj_file_path_branches], txt_file_path, mesh_mode)
 
     return None
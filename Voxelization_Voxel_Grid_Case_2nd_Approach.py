@@ -1,31 +1,14 @@
 import laspy
 import open3d as o3d
 import numpy as np
-import multiprocessing
 import os
+from VoxelMeshWriter import write_sparse_voxel_mesh
+from VoxelEngine import count_points_per_voxel, count_points_with_statistics, count_points_pyramid, count_points_streaming, las_sources_origin
+from SparseVoxelGrid import SparseVoxelGrid
+from VoxelRayTraversal import count_ray_hits, count_ray_hits_streaming, add_occlusion_attributes
 
-# Create a voxel as a cube using the centroid
-def create_voxel(x, y, z, size):
-    half_size = size / 2
-    vertices = [
-        (x - half_size, y - half_size, z - half_size),
-        (x + half_size, y - half_size, z - half_size),
-        (x + half_size, y + half_size, z - half_size),
-        (x - half_size, y + half_size, z - half_size),
-        (x - half_size, y - half_size, z + half_size),
-        (x + half_size, y - half_size, z + half_size),
-        (x + half_size, y + half_size, z + half_size),
-        (x - half_size, y + half_size, z + half_size),
-    ]
-    faces = [
-        (1, 2, 3, 4),
-        (5, 6, 7, 8),
-        (1, 5, 8, 4),
-        (2, 6, 7, 3),
-        (4, 3, 7, 8),
-        (1, 2, 6, 5),
-    ]
-    return vertices, faces
+# Upper transparency index of every class but the most transparent one, densest class first
+TRANSPARENCY_EDGES = [0.25, 0.50, 0.75]
 
 def voxelize_las(las_point_cloud, voxel_size):
     """Converts LAS point cloud to a voxel grid."""
@@ -34,50 +17,33 @@ def voxelize_las(las_point_cloud, voxel_size):
     pcd.points = o3d.utility.Vector3dVector(points)
     return o3d.geometry.VoxelGrid.create_from_point_cloud(pcd, voxel_size)
 
-def points_inside_voxel(points_array, voxel, voxel_size):
-    x, y, z = voxel
-    half_size = voxel_size / 2
-    mask = (
-        (points_array[:, 0] >= x - half_size) & (points_array[:, 0] <= x + half_size) &
-        (points_array[:, 1] >= y - half_size) & (points_array[:, 1] <= y + half_size) &
-        (points_array[:, 2] >= z - half_size) & (points_array[:, 2] <= z + half_size)
-    )
-    return np.sum(mask)
+def transparency_classes(edges=TRANSPARENCY_EDGES, quantiles=None):
+    """Class numbers produced by a list of bin edges or quantiles, the most transparent class first."""
+    return list(range(1, len(edges if quantiles is None else quantiles) + 2))
 
+def classify_transparency(transparency_index, edges=TRANSPARENCY_EDGES, quantiles=None):
+    """Bins the transparency index into classes, from fixed edges or from quantiles of the index."""
+    if quantiles is not None:
+        edges = np.quantile(transparency_index, quantiles)
+    edges = np.asarray(edges, dtype=np.float64)
 
-def process_voxel(task):
-    x, y, z, voxel_size, points_array = task
-    # print(f"PID {os.getpid()} processing voxel at ({x:.2f}, {y:.2f}, {z:.2f})")
-    num_points = points_inside_voxel(points_array, (x, y, z), voxel_size)
-    return ((x, y, z), num_points)
+    # Bins are closed on the right, so every index falls in exactly one class: class len(edges) + 1
+    # holds the densest voxels (index <= edges[0]) and class 1 the most transparent ones
+    voxel_class = len(edges) + 1 - np.digitize(transparency_index, edges, right=True)
+    return voxel_class.astype(np.uint8), edges
 
-def examine_voxel(las_point_cloud, voxel_grid, voxel_size, voxels_dict_1, voxels_dict_2, voxels_dict_3, voxels_dict_4, num_points_list, txt_file_path):
-    # Inside examine_voxel
-    remove_indices = []
-    tasks = []
-    points_array = np.vstack((las_point_cloud.x, las_point_cloud.y, las_point_cloud.z)).T
-
-    for voxel in voxel_grid.get_voxels():
-        grid_index_np = np.array(voxel.grid_index, dtype=np.int32)
-        x, y, z = voxel_grid.get_voxel_center_coordinate(grid_index_np)
-        tasks.append((x, y, z, voxel_size, points_array))
+def reclassify_voxels(voxel_grid, edges=TRANSPARENCY_EDGES, quantiles=None):
+    """Re-bins the stored transparency index of a grid with another class scheme, without recounting."""
+    voxel_grid["class"], edges = classify_transparency(voxel_grid["transparency_index"], edges, quantiles)
+    return edges
 
-    with multiprocessing.Pool() as pool:
-        results = pool.map(process_voxel, tasks)
+def classify_voxels(grid_indices, totals, voxel_size, origin, txt_file_path, edges=TRANSPARENCY_EDGES, quantiles=None):
+    """Builds the sparse voxel grid with its transparency class and writes the count log."""
+    max_number_points = totals.max()
+    min_number_points = totals.min()
 
-    for (x, y, z), num_points in results:
-        num_points_list.append(num_points)
-        if num_points == 0:
-            grid_index = voxel_grid.get_voxel(np.array([x, y, z]))
-            if grid_index is not None:
-                remove_indices.append(grid_index)
-
-    # Remove empty voxels from the grid
-    for idx in remove_indices:
-        voxel_grid.remove_voxel(idx)
-
-    max_number_points = max(num_points_list)
-    min_number_points = min(num_points_list)
+    transparency_index = (max_number_points - totals) / max_number_points
+    voxel_class, edges = classify_transparency(transparency_index, edges, quantiles)
 
     with open(txt_file_path, 'w') as f:
         f.write("Voxel grid export log\n")
@@ -86,41 +52,131 @@ def examine_voxel(las_point_cloud, voxel_grid, voxel_size, voxels_dict_1, voxels
 
         line_1 = "Maximum number of points inside a voxel: " + str(max_number_points)
         line_2 = "Minimum number of points inside a voxel: " + str(min_number_points)
+        line_3 = "Transparency class edges: " + str(np.round(edges, 4).tolist())
         # print(line_1)
         # print(line_2)
         f.write(line_1 + "\n")
         f.write(line_2 + "\n")
+        f.write(line_3 + "\n")
+
+    return SparseVoxelGrid(grid_indices, origin, voxel_size, {
+        "count": totals.astype(np.int32),
+        "transparency_index": transparency_index.astype(np.float32),
+        "class": voxel_class,
+    })
+
+
+def examine_voxel(las_point_cloud, voxel_size, txt_file_path, counting="binned", worker_pool=None, points_key=None, edges=TRANSPARENCY_EDGES, quantiles=None, statistics=None):
+    """Counts the points per voxel and classifies the voxels.
+
+    statistics maps LAS dimensions to the per-voxel aggregates to compute in the same pass
+    (e.g. {"intensity": ["mean", "max"], "z": ["min", "max", "var"]}), stored as "<dimension>_<statistic>".
+    The voxels follow the lattice of an Open3D VoxelGrid of the points, without building the grid.
+    """
+    # Inside examine_voxel
+    points_array = np.vstack((las_point_cloud.x, las_point_cloud.y, las_point_cloud.z)).T
+    origin = points_array.min(axis=0) - voxel_size / 2
 
-    for (x, y, z), num_points in results:
-        transparency_index = (max_number_points - num_points) / max_number_points
+    voxel_statistics = {}
+    if statistics:
+        columns = {name: np.asarray(las_point_cloud[name], dtype=np.float64) for name in statistics}
 
-        if transparency_index <= 0.25:
-            voxels_dict_4[(x, y, z)] = transparency_index
-        elif transparency_index >= 0.26 and transparency_index <= 0.50:
-            voxels_dict_3[(x, y, z)] = transparency_index
-        elif transparency_index >= 0.51 and transparency_index <= 0.75:
-            voxels_dict_2[(x, y, z)] = transparency_index
+    # Every binned voxel holds at least one point, so no empty voxels have to be removed from the grid
+    if counting == "binned":
+        # Bin every point into its voxel once and count the points per voxel
+        if statistics:
+            grid_indices, totals, _, voxel_statistics = count_points_with_statistics(points_array, voxel_size, origin, columns, statistics)
         else:
-            voxels_dict_1[(x, y, z)] = transparency_index
+            grid_indices, totals, _ = count_points_per_voxel(points_array, voxel_size, origin)
+    elif counting == "pool":
+        # Same binning, split over the worker pool that reads the points from shared memory
+        if statistics:
+            # The dimensions to aggregate are published as extra columns after x, y, z
+            points_array = np.column_stack([points_array] + list(columns.values()))
+            column_indices = {name: 3 + column for column, name in enumerate(columns)}
+            grid_indices, totals, _, voxel_statistics = worker_pool.count_points_with_statistics((points_key, tuple(columns)), points_array, voxel_size, origin, column_indices, statistics)
+        else:
+            grid_indices, totals, _ = worker_pool.count_points_per_voxel(points_key, points_array, voxel_size, origin)
+    elif counting == "tiled":
+        # Voxel-aligned tiles binned in parallel by the workers
+        if statistics:
+            # The dimensions to aggregate are published as extra columns after x, y, z
+            points_array = np.column_stack([points_array] + list(columns.values()))
+            column_indices = {name: 3 + column for column, name in enumerate(columns)}
+            grid_indices, totals, _, voxel_statistics = worker_pool.count_points_tiled_with_statistics((points_key, tuple(columns)), points_array, voxel_size, origin, column_indices, statistics)
+        else:
+            grid_indices, totals, _ = worker_pool.count_points_tiled(points_key, points_array, voxel_size, origin)
+    else:
+        raise ValueError(f"Unknown counting mode: {counting}")
 
-    return voxels_dict_1, voxels_dict_2, voxels_dict_3, voxels_dict_4, num_points_list, voxel_grid
+    sparse_voxel_grid = classify_voxels(grid_indices, totals, voxel_size, origin, txt_file_path, edges, quantiles)
+    for name, values in voxel_statistics.items():
+        sparse_voxel_grid[name] = values
+    return sparse_voxel_grid
 
 
-def generate_obj_voxel_from_dictionary(voxels_dict, voxel_size, output_obj_file_path):
-    """Writes voxelized output as an OBJ file."""
-    written_voxels = [create_voxel(center[0], center[1], center[2], voxel_size) for center in voxels_dict]
+def generate_obj_voxel_from_grid(voxel_grid, voxel_class, output_obj_file_path, mesh_mode="cubes"):
+    """Writes the voxels of one class as a mesh file (OBJ, binary PLY or GLB, from the file extension)."""
+    class_voxels = voxel_grid.filter_class(voxel_class)
+    write_sparse_voxel_mesh(class_voxels, output_obj_file_path, mesh_mode)
+    return len(class_voxels)
 
-    with open(output_obj_file_path, 'w') as obj_file:
-        vertex_index = 1
-        for vertices, faces in written_voxels:
-            for vertex in vertices:
-                obj_file.write(f"v {vertex[0]} {vertex[1]} {vertex[2]}\n")
-            for face in faces:
-                obj_file.write(f"f {face[0] + vertex_index - 1} {face[1] + vertex_index - 1} "
-                               f"{face[2] + vertex_index - 1} {face[3] + vertex_index - 1}\n")
-            vertex_index += 8  # Move to the next voxel
+def export_voxels(voxel_grid, voxel_classes, output_obj_file_paths, txt_file_path, mesh_mode="cubes"):
+    # Open the file
+    with open(txt_file_path, 'a') as f:
+        # Save refined voxels to OBJ
+        i = 1
+        j = 0
+        for voxel_class in voxel_classes:
+            num_voxels = generate_obj_voxel_from_grid(voxel_grid, voxel_class, output_obj_file_paths[j], mesh_mode)
+            line = f"Total voxels saved at voxels_dict_{i}: {num_voxels}"
+            # print(line)
+            f.write(line + "\n")
+            i += 1
+            j += 1
 
-def voxels_creation(las_file_path, xyz_file_path, output_obj_file_path_1, output_obj_file_path_2, output_obj_file_path_3, output_obj_file_path_4, voxel_size, txt_file_path):
+def record_occlusion(voxel_grid, hits, passes, txt_file_path):
+    """Adds the ray hit/pass-through attributes to the grid, logs them and saves the grid next to the log."""
+    add_occlusion_attributes(voxel_grid, hits, passes)
+    with open(txt_file_path, 'a') as f:
+        f.write("Rays ending in a voxel (hits): " + str(hits.sum()) + "\n")
+        f.write("Rays crossing a voxel (passes): " + str(passes.sum()) + "\n")
+        f.write("Mean voxel hit ratio: " + str(round(float(voxel_grid["hit_ratio"].mean()), 4)) + "\n")
+    voxel_grid.save(os.path.splitext(txt_file_path)[0] + ".npz")
+
+def transparency_mesh_paths(output_path, voxel_size, voxel_classes, mesh_extension=".obj"):
+    """One mesh file path per transparency class."""
+    return [os.path.join(output_path, "voxels_" + str(voxel_size) + "_" + str(voxel_class) + "_m" + mesh_extension) for voxel_class in voxel_classes]
+
+def voxels_creation(las_file_path, xyz_file_path, output_obj_file_paths, voxel_size, txt_file_path, counting="binned", worker_pool=None, mesh_mode="cubes", edges=TRANSPARENCY_EDGES, quantiles=None, sun_directions=None, scanner_positions=None, statistics=None):
+    """Voxelizes the point cloud and writes one mesh per transparency class, in the order of output_obj_file_paths.
+
+    With sun_directions or scanner_positions, rays are also traced from every point towards
+    those sources and the hit ratio of every voxel is stored next to its transparency_index.
+    With statistics (see examine_voxel), the voxel attributes are also written to a CSV table next to the log.
+    """
+    trace_rays = sun_directions is not None or scanner_positions is not None
+
+    voxel_classes = transparency_classes(edges, quantiles)
+    if len(output_obj_file_paths) != len(voxel_classes):
+        raise ValueError(f"Expected {len(voxel_classes)} output paths, one per transparency class, got {len(output_obj_file_paths)}")
+
+    if counting == "streaming":
+        # Count straight from the LAS chunks, without loading the cloud or building the Open3D grid
+        origin = las_sources_origin([las_file_path], voxel_size)
+        counts = count_points_streaming([(las_file_path, None)], voxel_size, origin, statistics=statistics)
+        grid_indices, totals, _ = counts[:3]
+        sparse_voxel_grid = classify_voxels(grid_indices, totals, voxel_size, origin, txt_file_path, edges, quantiles)
+        if statistics:
+            for name, values in counts[3].items():
+                sparse_voxel_grid[name] = values
+        if trace_rays:
+            hits, passes = count_ray_hits_streaming(sparse_voxel_grid, las_file_path, sun_directions, scanner_positions)
+            record_occlusion(sparse_voxel_grid, hits, passes, txt_file_path)
+        if statistics:
+            sparse_voxel_grid.save_csv(os.path.splitext(txt_file_path)[0] + ".csv")
+        export_voxels(sparse_voxel_grid, voxel_classes, output_obj_file_paths, txt_file_path, mesh_mode)
+        return None
 
     # Read LAS file
     las = laspy.read(las_file_path)
@@ -133,35 +189,45 @@ def voxels_creation(las_file_path, xyz_file_path, output_obj_file_path_1, output
     # # Load a point cloud
     # pcd = o3d.io.read_point_cloud(xyz_file_path)
 
-    # Convert point cloud to a voxel grid with a specific voxel size
-    voxel_grid = voxelize_las(las, voxel_size)
-
     # Process voxels
-    voxels_dict_1 = {}
-    voxels_dict_2 = {}
-    voxels_dict_3 = {}
-    voxels_dict_4 = {}
-    num_points_list = []
-    voxels_dict_1, voxels_dict_2, voxels_dict_3, voxels_dict_4, num_points, voxel_grid = examine_voxel(las, voxel_grid, voxel_size, voxels_dict_1, voxels_dict_2, voxels_dict_3, voxels_dict_4, num_points_list, txt_file_path)
-
-    voxels_dict_list = [voxels_dict_1, voxels_dict_2, voxels_dict_3, voxels_dict_4]
-    output_obj_file_paths = [output_obj_file_path_1, output_obj_file_path_2, output_obj_file_path_3, output_obj_file_path_4]
+    sparse_voxel_grid = examine_voxel(las, voxel_size, txt_file_path, counting, worker_pool, las_file_path, edges, quantiles, statistics)
+
+    if trace_rays:
+        # Occlusion mode: how often each voxel stops or lets through the rays towards the sources
+        points_array = np.vstack((las.x, las.y, las.z)).T
+        hits, passes = count_ray_hits(sparse_voxel_grid, points_array, sun_directions, scanner_positions)
+        record_occlusion(sparse_voxel_grid, hits, passes, txt_file_path)
+
+    if statistics:
+        sparse_voxel_grid.save_csv(os.path.splitext(txt_file_path)[0] + ".csv")
+
     # o3d.visualization.draw_geometries([voxel_grid])
 
     # txt_file_path = "C:/THESIS_TUDELFT/voxel_case/voxel_counts_size" + str(voxel_size) + ".txt"
 
-    # Open the file
-    with open(txt_file_path, 'a') as f:
-        # Save refined voxels to OBJ
-        i = 1
-        j = 0
-        for voxels_dict in voxels_dict_list:
-            generate_obj_voxel_from_dictionary(voxels_dict, voxel_size, output_obj_file_paths[j])
-            line = f"Total voxels saved at voxels_dict_{i}: {len(voxels_dict)}"
-            # print(line)
-            f.write(line + "\n")
-            i += 1
-            j += 1
+    export_voxels(sparse_voxel_grid, voxel_classes, output_obj_file_paths, txt_file_path, mesh_mode)
+
+    return None
+
+
+def voxels_creation_pyramid(las_file_path, output_path, voxel_sizes, mesh_extension=".obj", mesh_mode="cubes", edges=TRANSPARENCY_EDGES, quantiles=None):
+    """Voxelizes the point cloud for every voxel size from one binning pass."""
+
+    # Read LAS file once
+    las = laspy.read(las_file_path)
+    points_array = np.vstack((las.x, las.y, las.z)).T
+
+    # All sizes share the same lattice origin so that coarser levels are built from finer ones
+    origin = points_array.min(axis=0)
+    levels = count_points_pyramid(points_array, voxel_sizes, origin)
+    voxel_classes = transparency_classes(edges, quantiles)
+
+    for voxel_size in voxel_sizes:
+        grid_indices, totals, _ = levels[voxel_size]
+        output_obj_file_paths = transparency_mesh_paths(output_path, voxel_size, voxel_classes, mesh_extension)
+        txt_file_path = os.path.join(output_path, "voxel_counts_size_" + str(voxel_size) + "_m.txt")
 
+        sparse_voxel_grid = classify_voxels(grid_indices, totals, voxel_size, origin, txt_file_path, edges, quantiles)
+        export_voxels(sparse_voxel_grid, voxel_classes, output_obj_file_paths, txt_file_path, mesh_mode)
 
     return None
@@ -1,52 +1,85 @@
-from CanopyExtraction import extracting_tree_crown_points
+from CanopyExtraction import extracting_tree_crown_points, dbscan_sweep
 from RemoveIndices import func_remove_indices
 from TreeCrownCreation import func_TreeCrownCreation
+from LasDataset import LasDataset
 import time
 import ast
 import os
 
-# Define the location of files
-script_dir = os.path.dirname(os.path.abspath(__file__))
-input_path = os.path.join(script_dir, "Input_Convex_Hull_Case")
-las_file = [f for f in os.listdir(input_path) if f.endswith(".las")]
-base_name, _ = os.path.splitext(las_file[0])
-initial_las_path = os.path.join(input_path, las_file[0])
-
-# Create the outputs
-os.makedirs("Output_Convex_Hull_Case", exist_ok=True)
-output_path = os.path.join(script_dir, "Output_Convex_Hull_Case")
-out_low_las = os.path.join(output_path, f"{base_name}_Cropped_low.las")
-tree_crown_las_path = os.path.join(output_path, f"{base_name}_Tree_crown.las")
-os.makedirs("Output_Convex_Hull_Case/labelled_las", exist_ok=True)
-os.makedirs("Output_Convex_Hull_Case/rings", exist_ok=True)
-folder_path_separated_las_files = os.path.join(output_path, "labelled_las")
-folder_path_rings = os.path.join(output_path, "rings")
-
-# Define parameters
-parameters_DBSCAN_path = os.path.join(input_path, "Parameters_DBSCAN.txt")
-with open(parameters_DBSCAN_path, "r", encoding="utf-8") as f:
-    first_line = f.readline().strip().split()
-    second_line = f.readline().strip().split()
-    third_line = f.readline().strip().split()
-    forth_line = f.readline().strip().split()
-    fifth_line = f.readline().strip().split()
-    sixth_line = f.readline().strip().split()
-
-dbscan_eps = float(first_line[1])
-dbscan_min_samples = int(second_line[1])
-inner_radius = float(third_line[1])
-outer_radius = float(forth_line[1])
-height = float(fifth_line[1])
-spacing = float(sixth_line[1])
-
-
-tree_crown_ply_path = os.path.join(output_path, f"{base_name}_Tree_crown.ply")
-output_high_points_obj = os.path.join(output_path, f"{base_name}_Tree_Crown_convex_hull.obj")
-image_path = os.path.join(output_path, "estimated_clusters.png")
-
-combined_deletion = extracting_tree_crown_points(initial_las_path, out_low_las, folder_path_separated_las_files, folder_path_rings, image_path, dbscan_eps, dbscan_min_samples, inner_radius, outer_radius, height, spacing)
-raw = input("Enter indices to remove in descending order (e.g. [62,55,54]): ")
-removing_indices = ast.literal_eval(raw)
-
-func_remove_indices(initial_las_path, removing_indices, combined_deletion, tree_crown_las_path)
-func_TreeCrownCreation(tree_crown_las_path, tree_crown_ply_path, output_high_points_obj)
+def main():
+
+    # Define the location of files
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    input_path = os.path.join(script_dir, "Input_Convex_Hull_Case")
+    las_file = [f for f in os.listdir(input_path) if f.endswith(".las")]
+    base_name, _ = os.path.splitext(las_file[0])
+    initial_las_path = os.path.join(input_path, las_file[0])
+
+    # Decode the input once, every stage below works on this dataset
+    dataset = LasDataset(initial_las_path)
+
+    # Create the outputs
+    os.makedirs("Output_Convex_Hull_Case", exist_ok=True)
+    output_path = os.path.join(script_dir, "Output_Convex_Hull_Case")
+    out_low_las = os.path.join(output_path, f"{base_name}_Cropped_low.las")
+    tree_crown_las_path = os.path.join(output_path, f"{base_name}_Tree_crown.las")
+    os.makedirs("Output_Convex_Hull_Case/labelled_las", exist_ok=True)
+    folder_path_separated_las_files = os.path.join(output_path, "labelled_las")
+    folder_path_rings = os.path.join(output_path, "rings")
+
+    # Define parameters
+    parameters_DBSCAN_path = os.path.join(input_path, "Parameters_DBSCAN.txt")
+    with open(parameters_DBSCAN_path, "r", encoding="utf-8") as f:
+        first_line = f.readline().strip().split()
+        second_line = f.readline().strip().split()
+        third_line = f.readline().strip().split()
+        forth_line = f.readline().strip().split()
+        fifth_line = f.readline().strip().split()
+        sixth_line = f.readline().strip().split()
+
+    dbscan_eps = float(first_line[1])
+    dbscan_min_samples = int(second_line[1])
+    inner_radius = float(third_line[1])
+    outer_radius = float(forth_line[1])
+    height = float(fifth_line[1])
+    spacing = float(sixth_line[1])
+    dbscan_thinning_size = None  # e.g. 0.02 clusters 2 cm voxel centroids instead of every low point
+    dbscan_n_jobs = -1  # processes used for the DBSCAN neighbour search, -1 uses every core
+    stem_processes = 1  # processes for the per-cluster stem search, None uses every core
+
+    # Sweep mode: report the number of clusters of every eps / min_samples pair and stop,
+    # the neighbour graph is searched once at the largest eps and cached next to the outputs
+    sweep_eps = []  # e.g. [0.1, 0.2, 0.3, 0.4]
+    sweep_min_samples = []  # e.g. [5, 10, 20, 40, 80]
+    if sweep_eps and sweep_min_samples:
+        graph_path = os.path.join(output_path, f"{base_name}_neighbour_graph.npz")
+        results = dbscan_sweep(dataset, sweep_eps, sweep_min_samples, graph_path, dbscan_thinning_size, dbscan_n_jobs)
+        with open(os.path.join(output_path, "DBSCAN_sweep.txt"), 'w') as f:
+            f.write("eps min_samples clusters noise_points\n")
+            for eps, min_samples, n_clusters, n_noise in results:
+                f.write(f"{eps} {min_samples} {n_clusters} {n_noise}\n")
+        return
+
+
+    tree_crown_ply_path = os.path.join(output_path, f"{base_name}_Tree_crown.ply")
+    output_high_points_obj = os.path.join(output_path, f"{base_name}_Tree_Crown_convex_hull.obj")
+    image_path = os.path.join(output_path, "estimated_clusters.png")  # None skips the cluster image
+    export_cluster_las = False  # True also writes the low points of every cluster to labelled_las/label_<i>.las
+    export_rings = False  # True writes the final ring of every cluster to rings/rings.stl, for debugging
+
+    combined_deletion = extracting_tree_crown_points(dataset, out_low_las, folder_path_separated_las_files, folder_path_rings, image_path, dbscan_eps, dbscan_min_samples, inner_radius, outer_radius, height, spacing, dbscan_thinning_size, dbscan_n_jobs, export_cluster_las, stem_processes, export_rings)
+    raw = input("Enter indices to remove in descending order (e.g. [62,55,54]): ")
+    removing_indices = ast.literal_eval(raw)
+
+    tree_crown = func_remove_indices(dataset, removing_indices, combined_deletion, tree_crown_las_path)
+    export_ply = False  # True also writes the tree crown points as PLY
+
+    # True writes one hull per remaining stem (crown points split by nearest stem) and a summary table
+    per_tree_hulls = False
+    hull_processes = 1  # processes computing the per-tree hulls, None uses every core
+    tree_summary_csv = os.path.join(output_path, f"{base_name}_Tree_Crowns.csv")
+    stems = combined_deletion if per_tree_hulls else None
+    func_TreeCrownCreation(tree_crown, tree_crown_ply_path if export_ply else None, output_high_points_obj, stems, hull_processes, tree_summary_csv)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import os
 import laspy
 import numpy as np
-import open3d as o3d
 from Cube import cubes
 import time
 
 def las_to_ply(las_path, ply_path):
+    # Open3D is only needed for this optional export
+    import open3d as o3d
+
     # Read LAS file
     las = laspy.read(las_path)
     points = np.vstack((las.x, las.y, las.z)).transpose()
@@ -48,13 +50,19 @@ def main():
     base_name = os.path.splitext(las_file[0])[0]
     out_points_ply = os.path.join(output_path, base_name + ".ply")
 
-    # Convert the cropped las file to ply file
+    # Convert the cropped las file to ply file (optional, the cubes are built from the LAS points directly)
     # out_points_ply = 'C:/THESIS_TUDELFT/DATA_AHN5/merged_tree_leaves_10.ply'
-    las_to_ply(initial_las_path, out_points_ply)
+    export_ply = False
+    if export_ply:
+        las_to_ply(initial_las_path, out_points_ply)
 
     # POINT CLOUD CASE
-    out_point_cloud_obj = os.path.join(output_path, base_name + ".obj")
-    cubes(out_points_ply, 0.02, out_point_cloud_obj)
+    instanced = False  # True writes one cube mesh plus a translation per point as .glb (EXT_mesh_gpu_instancing)
+    out_point_cloud_obj = os.path.join(output_path, base_name + (".glb" if instanced else ".obj"))
+    dedup = False  # True writes at most one cube per 2 cm cell
+    lod_sizes = []  # e.g. [0.05, 0.1] also writes coarser levels of detail
+    las = laspy.read(initial_las_path)
+    cubes(las, 0.02, out_point_cloud_obj, instanced, dedup, lod_sizes)
     txt_file_path_time = os.path.join(output_path, "Processing_time.txt")
     end_time = time.time()
 
@@ -3,7 +3,8 @@ import laspy
 import numpy as np
 import open3d as o3d
 from matplotlib import pyplot as plt
-from Voxelization_Voxel_Grid_Case_1rst_Approach import voxels_creation
+from Voxelization_Voxel_Grid_Case_1rst_Approach import voxels_creation, voxels_creation_pyramid, load_labelled_points
+from VoxelEngine import VoxelWorkerPool
 import time
 
 
@@ -63,26 +64,50 @@ def main():
     # VOXELS CASE
     time_recorder = []
     voxel_sizes = [0.03, 0.05, 0.07, 0.1, 0.3, 0.5]
+    mesh_extension = ".obj"  # ".ply" or ".glb" write much smaller binary meshes
+    counting = "pool"  # "binned" (one process), "pool" (shared-memory workers), "tiled" (one worker per voxel-aligned tile, no Open3D grid) or "streaming" (LAS chunks, bounded memory)
+    mesh_mode = "cubes"  # "culled" drops faces between neighbouring voxels, "greedy" also merges them
+    statistics = None  # e.g. {"intensity": ["mean", "max"], "z": ["min", "max", "var"]} writes per-voxel statistics to a CSV table
     branches_xyz_file_path = os.path.join(output_path, "Branches.xyz")
     leaves_xyz_file_path = os.path.join(output_path, "Leaves.xyz")
 
     las_to_xyz(branches_las_path, branches_xyz_file_path)
     las_to_xyz(leaves_las_path, leaves_xyz_file_path)
 
-    for i in voxel_sizes:
-        start_time = time.time()
-        print("Start of voxel construction of size of " + str(i) + "m")
-        output_obj_file_path_branches = os.path.join(output_path, "voxels_" + str(i) + "_branches.obj")
-        output_obj_file_path_leaves = os.path.join(output_path, "voxels_" + str(i) + "_leaves.obj")
-        voxel_size = i
-
-        txt_file_path = os.path.join(output_path, "voxel_counts_size_" + str(voxel_size) + "_m.txt")
-        txt_file_path_time = os.path.join(output_path, "Processing_time_per_voxel_size.txt")
-        voxels_creation(branches_las_path, leaves_las_path, output_obj_file_path_branches, output_obj_file_path_leaves, voxel_size, txt_file_path)
+    txt_file_path_time = os.path.join(output_path, "Processing_time_per_voxel_size.txt")
 
+    # Pyramid mode bins the points once and builds every voxel size from that pass
+    use_pyramid = False
+    if use_pyramid:
+        start_time = time.time()
+        print("Start of voxel construction of sizes " + str(voxel_sizes) + "m")
+        voxels_creation_pyramid(branches_las_path, leaves_las_path, output_path, voxel_sizes, mesh_extension, mesh_mode)
         end_time = time.time()
-        time_recorder.append(round(end_time - start_time))
-        print("End of voxel construction of size of " + str(voxel_size) + "m")
+        print("End of voxel construction of sizes " + str(voxel_sizes) + "m")
+
+        with open(txt_file_path_time, 'a') as f:
+            f.write("Voxel sizes (pyramid):" + str(voxel_sizes))
+            f.write("Time: " + str(round(end_time - start_time)))
+        return
+
+    # Branches and leaves are read and labelled once in memory for every voxel size
+    points_array = None if counting == "streaming" else load_labelled_points(branches_las_path, leaves_las_path, list(statistics or ()))
+
+    # The same workers and shared point buffer are reused for every voxel size
+    with VoxelWorkerPool() as worker_pool:
+        for i in voxel_sizes:
+            start_time = time.time()
+            print("Start of voxel construction of size of " + str(i) + "m")
+            output_obj_file_path_branches = os.path.join(output_path, "voxels_" + str(i) + "_branches" + mesh_extension)
+            output_obj_file_path_leaves = os.path.join(output_path, "voxels_" + str(i) + "_leaves" + mesh_extension)
+            voxel_size = i
+
+            txt_file_path = os.path.join(output_path, "voxel_counts_size_" + str(voxel_size) + "_m.txt")
+            voxels_creation(branches_las_path, leaves_las_path, output_obj_file_path_branches, output_obj_file_path_leaves, voxel_size, txt_file_path, counting=counting, worker_pool=worker_pool, mesh_mode=mesh_mode, points_array=points_array, statistics=statistics)
+
+            end_time = time.time()
+            time_recorder.append(round(end_time - start_time))
+            print("End of voxel construction of size of " + str(voxel_size) + "m")
 
     plt.plot(voxel_sizes, time_recorder, color='blue', marker='o',linestyle='-')
     plt.title("Amount of time spent for processing per voxel size (1rst Approach)")
@@ -3,7 +3,8 @@ import laspy
 import numpy as np
 import open3d as o3d
 from matplotlib import pyplot as plt
-from Voxelization_Voxel_Grid_Case_2nd_Approach  import voxels_creation
+from Voxelization_Voxel_Grid_Case_2nd_Approach  import voxels_creation, voxels_creation_pyramid, transparency_classes, transparency_mesh_paths
+from VoxelEngine import VoxelWorkerPool
 import time
 
 
@@ -61,26 +62,49 @@ def main():
     # VOXELS CASE
     time_recorder = []
     voxel_sizes = [0.03, 0.05, 0.07, 0.1, 0.3, 0.5]
+    mesh_extension = ".obj"  # ".ply" or ".glb" write much smaller binary meshes
+    counting = "pool"  # "binned" (one process), "pool" (shared-memory workers), "tiled" (one worker per voxel-aligned tile, no Open3D grid) or "streaming" (LAS chunks, bounded memory)
+    mesh_mode = "cubes"  # "culled" drops faces between neighbouring voxels, "greedy" also merges them
+    statistics = None  # e.g. {"intensity": ["mean", "max"], "z": ["min", "max", "var"]} writes per-voxel statistics to a CSV table
+    transparency_edges = [0.25, 0.50, 0.75]  # Upper transparency index of each class, densest class first
+    transparency_quantiles = None  # e.g. [0.25, 0.5, 0.75] bins by quantiles of the index instead of fixed edges
+    voxel_classes = transparency_classes(transparency_edges, transparency_quantiles)
+    sun_directions = None  # e.g. [VoxelRayTraversal.sun_direction(180, 45)] adds the per-voxel ray hit ratio (azimuth, elevation in degrees)
+    scanner_positions = None  # e.g. [(x, y, z)] of the scan stations, also traced when given
     xyz_file_path = os.path.join(output_path, "Study_area.xyz")
 
     las_to_xyz(initial_las_path, xyz_file_path)
 
-    for i in voxel_sizes:
-        start_time = time.time()
-        print("Start of voxel construction of size of " + str(i) + "m")
-        output_obj_file_path_1 = os.path.join(output_path, "voxels_" + str(i) + "_1_m.obj")
-        output_obj_file_path_2 = os.path.join(output_path, "voxels_" + str(i) + "_2_m.obj")
-        output_obj_file_path_3 = os.path.join(output_path, "voxels_" + str(i) + "_3_m.obj")
-        output_obj_file_path_4 = os.path.join(output_path, "voxels_" + str(i) + "_4_m.obj")
-        voxel_size = i
-
-        txt_file_path = os.path.join(output_path, "voxel_counts_size_" + str(voxel_size) + "_m.txt")
-        txt_file_path_time = os.path.join(output_path, "Processing_time_per_voxel_size.txt")
-        voxels_creation(initial_las_path, output_obj_file_path_1, output_obj_file_path_2, output_obj_file_path_3, output_obj_file_path_4, voxel_size, txt_file_path)
+    txt_file_path_time = os.path.join(output_path, "Processing_time_per_voxel_size.txt")
 
+    # Pyramid mode bins the points once and builds every voxel size from that pass
+    use_pyramid = False
+    if use_pyramid:
+        start_time = time.time()
+        print("Start of voxel construction of sizes " + str(voxel_sizes) + "m")
+        voxels_creation_pyramid(initial_las_path, output_path, voxel_sizes, mesh_extension, mesh_mode, transparency_edges, transparency_quantiles)
         end_time = time.time()
-        time_recorder.append(round(end_time - start_time))
-        print("End of voxel construction of size of " + str(voxel_size) + "m")
+        print("End of voxel construction of sizes " + str(voxel_sizes) + "m")
+
+        with open(txt_file_path_time, 'a') as f:
+            f.write("Voxel sizes (pyramid):" + str(voxel_sizes))
+            f.write("Time: " + str(round(end_time - start_time)))
+        return
+
+    # The same workers and shared point buffer are reused for every voxel size
+    with VoxelWorkerPool() as worker_pool:
+        for i in voxel_sizes:
+            start_time = time.time()
+            print("Start of voxel construction of size of " + str(i) + "m")
+            output_obj_file_paths = transparency_mesh_paths(output_path, i, voxel_classes, mesh_extension)
+            voxel_size = i
+
+            txt_file_path = os.path.join(output_path, "voxel_counts_size_" + str(voxel_size) + "_m.txt")
+            voxels_creation(initial_las_path, xyz_file_path, output_obj_file_paths, voxel_size, txt_file_path, counting=counting, worker_pool=worker_pool, mesh_mode=mesh_mode, edges=transparency_edges, quantiles=transparency_quantiles, sun_directions=sun_directions, scanner_positions=scanner_positions, statistics=statistics)
+
+            end_time = time.time()
+            time_recorder.append(round(end_time - start_time))
+            print("End of voxel construction of size of " + str(voxel_size) + "m")
 
     plt.plot(voxel_sizes, time_recorder, color='blue', marker='o',linestyle='-')
     plt.title("Amount of time spent for processing per voxel size (2nd Approach)")